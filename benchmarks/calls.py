@@ -0,0 +1,61 @@
+"""Time call-heavy loops with the call site caches and with a lookup on
+every call, best of three runs.
+
+The loop runs inside nested blocks which each define a variable, so an
+uncached lookup has to search one frame per level to find the functions.
+"""
+
+import time
+
+from main import execute
+from lang import ast
+from lang.scope import Scope
+
+CALLS = 50_000
+
+SOURCE = """
+fn add(a: int, b: int) {{ a + b }}
+fn half(x: float) {{ x * 0.5 }}
+{open}
+total := 0
+f := 0.0
+for i := 0; i < {n}; i = i + 1 {{
+    total = add(total, i)
+    f = half(f)
+}}
+{close}
+"""
+
+
+def bench(depth, cached):
+    source = SOURCE.format(
+        n=CALLS,
+        open="".join(f"{{ v{i} := {i}\n" for i in range(depth)),
+        close="}" * depth,
+    )
+    resolve = ast.Call.resolve
+    if not cached:
+
+        def uncached(call, scope):
+            call.cache = None
+            return resolve(call, scope)
+
+        ast.Call.resolve = uncached
+    try:
+        times = []
+        for _ in range(3):
+            started = time.perf_counter()
+            execute(Scope(), source)
+            times.append(time.perf_counter() - started)
+        return min(times)
+    finally:
+        ast.Call.resolve = resolve
+
+
+if __name__ == "__main__":
+    print(f"{'depth':>6} {'cached':>9} {'per call':>10} {'uncached':>9}")
+    for depth in (0, 10, 50):
+        cached = bench(depth, True)
+        uncached = bench(depth, False)
+        per_call = cached / (2 * CALLS) * 1e6
+        print(f"{depth:>6} {cached:>8.2f}s {per_call:>8.2f}us {uncached:>8.2f}s")
@@ -0,0 +1,411 @@
+"""Run tests, examples and random programs under every execution mode.
+
+Each mode must print the same output and return the same value as the
+reference tree walker. Programs which diverge are reduced line by line to a
+smaller program which still diverges. The table at the end shows the total
+time per mode and the speedup over the reference.
+
+    python -m benchmarks.differential --random 200 --seed 1
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import re
+import time
+from pathlib import Path
+
+from rply import LexingError, ParsingError
+
+from main import execute, lexer, parser
+from lang import check, serialize
+from lang.limits import Limits, LimitExceeded
+from lang.memo import Memo
+from lang.numeric import Numeric
+from lang.scope import Scope
+
+# Removing lines while minimizing can leave loops without an end
+MAX_STEPS = 100_000
+MAX_TIME = 2
+
+# Printed by the dead code pass of -O, not by the program
+REMOVED = re.compile(r"^Removing \d+ unused definitions\n", re.MULTILINE)
+
+
+def serialized(source):
+    """Parse source and load it back from its serialized form."""
+    try:
+        program = parser.parse(lexer.lex(source))
+    except (LexingError, ParsingError):
+        return source
+    return serialize.loads(serialize.dumps(program))
+
+
+# Name, function preparing the source and keyword arguments of execute, and
+# whether the mode is also compared on programs which fail. -O evaluates the
+# whole program once before running it, so it fails earlier than the
+# reference, and lazy parsing only fails on a broken body when it is called.
+MODES = [
+    ("reference", lambda source: (source, {}), True),
+    ("optimize", lambda source: (source, {"opt": True}), False),
+    ("memo", lambda source: (source, {"memo": Memo()}), True),
+    ("lazy", lambda source: (source, {"lazy": True}), False),
+    ("serialized", lambda source: (serialized(source), {}), True),
+    ("numeric", lambda source: (source, {"numeric": Numeric()}), True),
+    (
+        "all",
+        lambda source: (
+            source,
+            {"opt": True, "memo": Memo(), "lazy": True, "numeric": Numeric()},
+        ),
+        False,
+    ),
+]
+
+
+def run(source, prepare):
+    """Return the output, the result or error and the time of one run."""
+    started = time.perf_counter()
+    source, options = prepare(source)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            result = repr(
+                execute(Scope(), source, limits=Limits(MAX_STEPS, MAX_TIME), **options)
+            )
+        except LimitExceeded:
+            result = "limit exceeded"
+        except RecursionError:
+            # The message depends on where Python's stack ran out
+            result = "RecursionError"
+        except Exception as err:
+            result = f"{type(err).__name__}: {err}"
+    elapsed = time.perf_counter() - started
+    return REMOVED.sub("", out.getvalue()), result, elapsed
+
+
+def reference(source):
+    return run(source, MODES[0][1])
+
+
+def is_valid(source):
+    """Whether source passes the static checks and runs without errors."""
+    try:
+        program = parser.parse(lexer.lex(source))
+    except (LexingError, ParsingError):
+        return False
+    if check.check(program):
+        return False
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            program.eval(False, Scope(limits=Limits(MAX_STEPS, MAX_TIME)))
+    except Exception:
+        return False
+    return True
+
+
+def diverges(source, prepare):
+    return reference(source)[:2] != run(source, prepare)[:2]
+
+
+def minimize(source, prepare):
+    """Drop lines, then pairs of lines, while the program still diverges.
+
+    Smaller programs must still be valid, otherwise the search drifts
+    towards programs which merely fail at different points.
+    """
+    lines = source.splitlines()
+    for width in (1, 2):
+        changed = True
+        while changed:
+            changed = False
+            i = 0
+            while i < len(lines):
+                candidate = lines[:i] + lines[i + width :]
+                candidate_source = "\n".join(candidate)
+                if is_valid(candidate_source) and diverges(candidate_source, prepare):
+                    lines = candidate
+                    changed = True
+                else:
+                    i += 1
+    return "\n".join(lines)
+
+
+def indent(lines):
+    return ["    " + line for line in lines]
+
+
+class Generator:
+    """Generates well-typed programs using the productions of the parser.
+
+    Every statement is on its own line. Loops run a few times, divisors are
+    non-zero literals, casts never parse strings or overflow and values grow
+    at most polynomially with the number of iterations, so programs only
+    fail if a mode is wrong.
+    """
+
+    TYPES = ("int", "float", "str", "bool")
+
+    def __init__(self, rng, max_depth=3):
+        self.rng = rng
+        self.max_depth = max_depth
+        self.names = 0
+        # Frames of variables as name -> (type, assignable)
+        self.env = [{}]
+        # Functions as name -> (parameter types, result type)
+        self.functions = {}
+
+    def name(self, prefix):
+        self.names += 1
+        return f"{prefix}{self.names}"
+
+    def variables(self, type, assignable=False):
+        found = {}
+        for frame in self.env:
+            for name, (t, can_assign) in frame.items():
+                found[name] = (t, can_assign)
+        return [
+            name
+            for name, (t, can_assign) in found.items()
+            if t == type and (can_assign or not assignable)
+        ]
+
+    def program(self, statements=12):
+        lines = []
+        for _ in range(statements):
+            if self.rng.random() < 0.25:
+                lines.extend(self.function())
+            else:
+                lines.extend(self.statement(0))
+        return "\n".join(lines) + "\n"
+
+    def function(self):
+        name = self.name("f")
+        count = self.rng.randint(0, 3)
+        params = [self.rng.choice(self.TYPES) for _ in range(count)]
+        result = self.rng.choice(self.TYPES)
+        names = [self.name("p") for _ in params]
+
+        # Functions only see their parameters and other functions
+        outer = self.env
+        self.env = [dict((n, (t, False)) for n, t in zip(names, params))]
+        signature = ", ".join(f"{n}: {t}" for n, t in zip(names, params))
+        body = []
+        for _ in range(self.rng.randint(0, 3)):
+            body.extend(self.statement(1))
+        # A line starting with a parenthesis would continue the previous one
+        # as a call, so the result is returned through a variable
+        value = self.name("r")
+        body.append(f"{value} := {self.expr(result, 1)}")
+        body.append(value)
+        lines = [f"fn {name}({signature}) {{"] + indent(body) + ["}"]
+        self.env = outer
+
+        self.functions[name] = (params, result)
+        return lines
+
+    def statement(self, depth):
+        choices = ["define", "define", "print"]
+        if any(self.variables(t, assignable=True) for t in self.TYPES):
+            choices += ["assign", "assign"]
+        if depth < self.max_depth:
+            choices += ["if", "for", "while", "block"]
+        kind = self.rng.choice(choices)
+
+        if kind == "define":
+            type = self.rng.choice(self.TYPES)
+            value = self.expr(type, depth)
+            name = self.name("v")
+            self.env[-1][name] = (type, True)
+            return [f"{name} := {value}"]
+        elif kind == "assign":
+            types = [t for t in self.TYPES if self.variables(t, assignable=True)]
+            type = self.rng.choice(types)
+            name = self.rng.choice(self.variables(type, assignable=True))
+            return [f"{name} = {self.expr(type, depth)}"]
+        elif kind == "print":
+            type = self.rng.choice(self.TYPES)
+            return [f"println({self.expr(type, depth)})"]
+        elif kind == "if":
+            lines = [f"if {self.expr('bool', depth)} {{"]
+            lines += self.body(depth + 1)
+            if self.rng.random() < 0.5:
+                lines += ["} else {"] + self.body(depth + 1)
+            return lines + ["}"]
+        elif kind == "for":
+            counter = self.name("k")
+            count = self.rng.randint(0, 4)
+            self.env.append({counter: ("int", False)})
+            step = f"{counter} = {counter} + 1"
+            header = f"for {counter} := 0; {counter} < {count}; {step} {{"
+            lines = [header] + self.body(depth + 1) + ["}"]
+            self.env.pop()
+            return lines
+        elif kind == "while":
+            counter = self.name("w")
+            count = self.rng.randint(0, 4)
+            # The counter cannot be assigned by the body
+            self.env[-1][counter] = ("int", False)
+            lines = [f"{counter} := 0", f"while {counter} < {count} {{"]
+            lines += self.body(depth + 1) + indent([f"{counter} = {counter} + 1"])
+            return lines + ["}"]
+        else:
+            return ["{"] + self.body(depth + 1) + ["}"]
+
+    def body(self, depth):
+        self.env.append({})
+        lines = []
+        for _ in range(self.rng.randint(1, 3)):
+            lines.extend(self.statement(depth))
+        self.env.pop()
+        return indent(lines)
+
+    def expr(self, type, depth):
+        rng = self.rng
+        options = [self.literal]
+        if self.variables(type):
+            options += [self.variable] * 3
+        if depth < self.max_depth:
+            options += [self.operation] * 3
+            if any(result == type for _, result in self.functions.values()):
+                options.append(self.call)
+            options += [self.cast, self.if_else]
+        return rng.choice(options)(type, depth)
+
+    def literal(self, type, depth):
+        rng = self.rng
+        if type == "int":
+            return str(rng.randint(0, 20))
+        elif type == "float":
+            return f"{rng.randint(0, 20)}.{rng.randint(0, 9)}"
+        elif type == "str":
+            return '"' + "".join(rng.choice("abc xyz") for _ in range(3)) + '"'
+        return rng.choice(("true", "false"))
+
+    def variable(self, type, depth):
+        return self.rng.choice(self.variables(type))
+
+    def operation(self, type, depth):
+        rng = self.rng
+        depth += 1
+        if type == "int":
+            op = rng.choice(("+", "-", "*", "%"))
+            if op in ("*", "%"):
+                return f"({self.expr('int', depth)} {op} {rng.randint(1, 9)})"
+            return f"({self.expr('int', depth)} {op} {self.expr('int', depth)})"
+        elif type == "float":
+            op = rng.choice(("+", "-", "*", "/", "builtin"))
+            if op == "/":
+                return f"({self.expr('float', depth)} / {rng.randint(1, 9)}.5)"
+            if op == "builtin":
+                name = rng.choice(("sin", "cos"))
+                return f"{name}({self.expr('float', depth)})"
+            left = self.expr(rng.choice(("int", "float")), depth)
+            return f"({left} {op} {self.expr('float', depth)})"
+        elif type == "str":
+            # One side is a literal, so a string cannot double on each pass
+            if rng.random() < 0.5:
+                return f"({self.expr('str', depth)} + {self.literal('str', depth)})"
+            return f"({self.literal('str', depth)} + {self.expr('str', depth)})"
+
+        kind = rng.choice(("compare", "logic", "not", "equal"))
+        if kind == "compare":
+            op = rng.choice(("<", "<=", ">", ">=", "==", "!="))
+            left = self.expr(rng.choice(("int", "float")), depth)
+            return f"({left} {op} {self.expr(rng.choice(('int', 'float')), depth)})"
+        elif kind == "logic":
+            op = rng.choice(("&&", "||"))
+            return f"({self.expr('bool', depth)} {op} {self.expr('bool', depth)})"
+        elif kind == "not":
+            return f"!({self.expr('bool', depth)})"
+        op = rng.choice(("==", "!="))
+        return f"({self.expr('str', depth)} {op} {self.expr('str', depth)})"
+
+    def call(self, type, depth):
+        name = self.rng.choice(
+            [n for n, (_, result) in self.functions.items() if result == type]
+        )
+        params, _ = self.functions[name]
+        args = ", ".join(self.expr(t, depth + 1) for t in params)
+        return f"{name}({args})"
+
+    def cast(self, type, depth):
+        if type == "int":
+            source = self.rng.choice(("int", "bool"))
+        elif type == "float":
+            source = self.rng.choice(("int", "float"))
+        elif type == "str":
+            source = self.rng.choice(self.TYPES)
+        else:
+            source = "bool"
+        return f"cast({type}, {self.expr(source, depth + 1)})"
+
+    def if_else(self, type, depth):
+        depth += 1
+        cond = self.expr("bool", depth)
+        true = self.expr(type, depth)
+        false = self.expr(type, depth)
+        return f"(if {cond} {{ {true} }} else {{ {false} }})"
+
+
+def corpus(count, seed):
+    for directory in ("tests", "examples"):
+        for path in sorted(Path(directory).glob("*.kut")):
+            source = path.read_text()
+            if "###" in source:
+                _, source, _ = source.split("###", 2)
+            yield str(path), source
+    rng = random.Random(seed)
+    for i in range(count):
+        yield f"random {seed}:{i}", Generator(rng).program()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "-n", "--random", help="number of random programs", type=int, default=100
+    )
+    arg_parser.add_argument("-s", "--seed", help="random seed", type=int, default=0)
+    arg_parser.add_argument(
+        "--show", help="print every random program", action="store_true"
+    )
+    args = arg_parser.parse_args()
+
+    # Per mode: programs run, their time in the mode and in the reference
+    counts = {name: 0 for name, _, _ in MODES}
+    times = {name: 0.0 for name, _, _ in MODES}
+    reference_times = {name: 0.0 for name, _, _ in MODES}
+    failures = {name: 0 for name, _, _ in MODES}
+    for label, source in corpus(args.random, args.seed):
+        if args.show:
+            print(f"== {label}\n{source}")
+        expected = reference(source)
+        valid = None
+        for name, prepare, strict in MODES:
+            if not strict:
+                if valid is None:
+                    valid = is_valid(source)
+                if not valid:
+                    continue
+            actual = expected if name == "reference" else run(source, prepare)
+            counts[name] += 1
+            times[name] += actual[2]
+            reference_times[name] += expected[2]
+            if actual[:2] != expected[:2]:
+                failures[name] += 1
+                print(f"{label}: {name} diverges, minimized program:")
+                print(minimize(source, prepare))
+                print()
+
+    print(f"{'mode':<12} {'programs':>8} {'time':>9} {'speedup':>8} {'diverged':>9}")
+    for name, _, _ in MODES:
+        speedup = reference_times[name] / times[name] if times[name] else 0
+        print(
+            f"{name:<12} {counts[name]:>8} {times[name]:>8.3f}s {speedup:>7.2f}x"
+            f" {failures[name]:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
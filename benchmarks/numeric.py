@@ -0,0 +1,77 @@
+"""Time numeric loops on the general interpreter and on the typed tier,
+best of three runs.
+
+Each kernel is run once as a function, which is compiled as a whole, and
+once as a loop at the top level, which is compiled with the global
+variables it uses.
+"""
+
+import time
+
+from main import execute
+from lang.numeric import Numeric
+from lang.scope import Scope
+
+N = 100_000
+
+KERNELS = {
+    "fib": """
+a := 0
+b := 1
+for i := 0; i < n; i = i + 1 {
+    t := a + b
+    a = b
+    b = t % 1000000007
+}
+""",
+    "leibniz": """
+s := 0.0
+sign := 1.0
+for k := 0; k < n; k = k + 1 {
+    s = s + sign / (2 * k + 1)
+    sign = 0.0 - sign
+}
+""",
+    "collatz": """
+steps := 0
+for k := 1; k < n / 10; k = k + 1 {
+    x := cast(float, k)
+    while x != 1 {
+        x = if x % 2 == 0 { x / 2 } else { 3 * x + 1 }
+        steps = steps + 1
+    }
+}
+""",
+}
+
+
+def source(body, function):
+    if function:
+        return f"fn kernel(n: int) {{\n{body}\n}}\nkernel({N})\n"
+    return f"n := {N}\n{body}"
+
+
+def bench(body, function, numeric):
+    times = []
+    for _ in range(3):
+        started = time.perf_counter()
+        execute(
+            Scope(),
+            source(body, function),
+            numeric=Numeric() if numeric else None,
+        )
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+if __name__ == "__main__":
+    print(f"{'kernel':>16} {'general':>9} {'numeric':>9} {'speedup':>8}")
+    for name, body in KERNELS.items():
+        for function in (True, False):
+            label = f"{name} ({'fn' if function else 'loop'})"
+            general = bench(body, function, False)
+            numeric = bench(body, function, True)
+            print(
+                f"{label:>16} {general:>8.2f}s {numeric:>8.2f}s"
+                f" {general / numeric:>7.2f}x"
+            )
@@ -0,0 +1,38 @@
+"""Startup time of a library-style script where few of the many functions
+are called, with eager and lazy parsing of function bodies."""
+
+import time
+
+from main import execute
+from lang.scope import Scope
+
+FUNCTIONS = 2000
+CALLED = 20
+LINES = 24
+
+
+def generate():
+    lines = []
+    for i in range(FUNCTIONS):
+        lines.append(f"fn f{i}(x: int) {{")
+        lines.append("    total := 0")
+        for j in range(LINES - 4):
+            lines.append(f"    if x > {j} {{ total = total + x * {j} }}")
+        lines.append("    total")
+        lines.append("}")
+    for i in range(0, FUNCTIONS, FUNCTIONS // CALLED):
+        lines.append(f"f{i}(3)")
+    return "\n".join(lines)
+
+
+def measure(source, lazy):
+    started = time.perf_counter()
+    execute(Scope(), source, lazy=lazy)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    source = generate()
+    print(f"{source.count(chr(10)) + 1} lines, {FUNCTIONS} functions, {CALLED} called")
+    print(f"eager: {measure(source, False):.2f}s")
+    print(f"lazy:  {measure(source, True):.2f}s")
@@ -0,0 +1,51 @@
+"""Count scope frames allocated by loop-heavy code in the style of
+examples/nested.kut."""
+
+import time
+
+from main import execute
+from lang import scope
+from lang.scope import Scope
+
+SOURCE = """
+fn function() {
+    a := 2
+    fn nested() {
+        a = a + 1
+    }
+
+    for i := 0; i < 20000; i = i + 1 {
+        nested()
+        if i % 2 == 0 { a = a - 1 }
+    }
+
+    b := 0
+    while b < 20000 {
+        temp := b
+        b = temp + 1
+    }
+}
+
+function()
+"""
+
+
+class CountingSymbols(scope.Symbols):
+    allocated = 0
+
+    def __init__(self):
+        super().__init__()
+        CountingSymbols.allocated += 1
+
+
+if __name__ == "__main__":
+    original = scope.Symbols
+    scope.Symbols = CountingSymbols
+    try:
+        started = time.perf_counter()
+        execute(Scope(), SOURCE)
+        elapsed = time.perf_counter() - started
+    finally:
+        scope.Symbols = original
+    print(f"frames allocated: {CountingSymbols.allocated}")
+    print(f"time: {elapsed:.2f}s")
@@ -0,0 +1,141 @@
+"""Load test of the execution service with a local client.
+
+Runs a mix of registered programs with varying inputs through pools of
+different sizes, with a fixed number of jobs in flight, and reports the
+throughput and latency percentiles seen by the client. For comparison, the
+last row starts a new interpreter process for every job.
+
+    python -m benchmarks.service --jobs 2000 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from service import Service
+
+PROGRAMS = {
+    "fib": (
+        """
+fn fib(n: int) { if n < 2 { n } else { fib(n - 1) + fib(n - 2) } }
+fib(k)
+""",
+        lambda rng: {"k": rng.randint(5, 12)},
+    ),
+    "greet": (
+        """
+s := ""
+for i := 0; i < k; i = i + 1 { s = s + name }
+println(s)
+""",
+        lambda rng: {"k": rng.randint(1, 20), "name": rng.choice(["ab", "xyz"])},
+    ),
+    "sum": (
+        """
+total := 0.0
+for i := 0; i < k; i = i + 1 { total = total + i / x }
+total
+""",
+        lambda rng: {"k": rng.randint(100, 1000), "x": rng.random() + 0.5},
+    ),
+}
+
+
+def jobs(count, seed):
+    rng = random.Random(seed)
+    names = sorted(PROGRAMS)
+    for _ in range(count):
+        name = rng.choice(names)
+        yield name, PROGRAMS[name][1](rng)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def load(workers, count, concurrency, seed):
+    latencies = []
+    errors = 0
+    async with Service(workers=workers) as service:
+        ids = {name: service.register(PROGRAMS[name][0]) for name in PROGRAMS}
+        pending = iter(list(jobs(count, seed)))
+
+        async def client():
+            nonlocal errors
+            for name, inputs in pending:
+                started = time.perf_counter()
+                result = await service.run(program=ids[name], inputs=inputs)
+                latencies.append(time.perf_counter() - started)
+                errors += result["error"] is not None
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies, errors
+
+
+def shell_out(count, seed):
+    """Run each job by starting main.py on a script defining the inputs."""
+    latencies = []
+    main = os.path.join(os.path.dirname(os.path.dirname(__file__)), "main.py")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "job.kut")
+        started = time.perf_counter()
+        for name, inputs in jobs(count, seed):
+            job_started = time.perf_counter()
+            with open(path, "w") as f:
+                for key, value in inputs.items():
+                    literal = f'"{value}"' if isinstance(value, str) else value
+                    f.write(f"{key} := {literal}\n")
+                f.write(PROGRAMS[name][0])
+            subprocess.run([sys.executable, main, path], capture_output=True)
+            latencies.append(time.perf_counter() - job_started)
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies, 0
+
+
+def report(label, count, elapsed, latencies, errors):
+    print(
+        f"{label:>10} {count:>6} {count / elapsed:>9.1f}"
+        f" {percentile(latencies, 0.5) * 1000:>8.2f}ms"
+        f" {percentile(latencies, 0.99) * 1000:>8.2f}ms {errors:>6}"
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "-n", "--jobs", help="jobs per pool", type=int, default=2000
+    )
+    arg_parser.add_argument(
+        "-c", "--concurrency", help="jobs in flight", type=int, default=16
+    )
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        help="pool sizes to test",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+    )
+    arg_parser.add_argument(
+        "--shell-out", help="jobs run as separate processes", type=int, default=50
+    )
+    arg_parser.add_argument("-s", "--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    print(
+        f"{'workers':>10} {'jobs':>6} {'jobs/s':>9} {'p50':>10} {'p99':>10}"
+        f" {'errors':>6}"
+    )
+    for workers in args.workers:
+        result = asyncio.run(load(workers, args.jobs, args.concurrency, args.seed))
+        report(str(workers), args.jobs, *result)
+    if args.shell_out:
+        report("shell out", args.shell_out, *shell_out(args.shell_out, args.seed))
@@ -0,0 +1,33 @@
+"""Time building a string with repeated `s = s + "x"` appends.
+
+The builder path should take a constant time per append. The baseline wraps
+the variable in a cast, which opts out of the string builder optimization.
+"""
+
+import time
+
+from main import execute
+from lang.scope import Scope
+
+SOURCE = """
+s := ""
+for i := 0; i < {n}; i = i + 1 {{ s = {left} + "x" }}
+"""
+
+
+def bench(n, left):
+    source = SOURCE.format(n=n, left=left)
+    started = time.perf_counter()
+    execute(Scope(), source)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    print(f"{'appends':>10} {'builder':>10} {'per append':>12} {'baseline':>10}")
+    for n in (100_000, 200_000, 500_000, 1_000_000):
+        builder = bench(n, "s")
+        baseline = bench(n, "cast(str, s)") if n <= 200_000 else None
+        line = f"{n:>10} {builder:>9.2f}s {builder / n * 1e6:>10.2f}us"
+        if baseline is not None:
+            line += f" {baseline:>9.2f}s"
+        print(line)
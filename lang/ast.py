@@ -1,41 +1,104 @@
 import operator
 import math
+import weakref
 
-from lang.scope import Scope
+from lang.scope import Scope, StrBuilder, Symbols, versions
+
+BUILTINS = {"sin": math.sin, "cos": math.cos, "pi": lambda: math.pi}
+
+# Functions whose bodies the optimizing pass is walking. A recursive call
+# is not walked again and its value, like values computed from it, is None.
+walking = set()
 
 
 class Node:
-    def id(self):
-        return str(hash(self))
+    # Names of the attributes set by __init__, in argument order
+    fields = ()
+
+    def label(self):
+        return self.__class__.__name__
+
+    def children(self):
+        for name in self.fields:
+            value = getattr(self, name)
+            if isinstance(value, Node):
+                yield value
+            elif isinstance(value, list):
+                yield from value
+
+    def walk(self):
+        yield self
+        for child in self.children():
+            yield from child.walk()
+
+
+def has_effects(node):
+    """Whether evaluating node may do more than compute its value."""
+    for child in node.walk():
+        if isinstance(child, Call) and child.symbol not in BUILTINS:
+            return True
+        if isinstance(child, (Assign, Print)):
+            return True
+    return False
 
 
 class Program(Node):
+    fields = ("block",)
+
     def __init__(self, block):
         self.block = block
 
     def eval(self, opt, scope):
         return self.block.eval(opt, scope)
 
-    def draw(self, g):
-        g.node(self.id(), "Program")
-        g.edge(self.id(), self.block.draw(g))
-        return self.id()
-
 
 class Block(Node):
+    fields = ("block",)
+
+    # Filled in by analyze() on first evaluation
+    defines = None
+    reusable = None
+
     def __init__(self, block):
         self.block = block
 
-    def eval(self, opt, scope, args={}):
+    def analyze(self):
+        # A block which defines nothing can run in the enclosing frame
+        self.defines = any(isinstance(stmt, (Define, Fn)) for stmt in self.block)
+        # Functions may capture the frame, so it cannot be reset and reused
+        self.reusable = not any(isinstance(node, Fn) for node in self.walk())
+
+    def loop_frame(self):
+        """Return a frame which every iteration of a loop over this block
+        can reuse, or None if each iteration needs a new one."""
         if self.block is None:
             return None
-        scope.push()
-        for name, value in args.items():
-            scope.add(name, value)
-        value = None
-        for stmt in self.block:
-            value = stmt.eval(opt, scope)
-        scope.pop()
+        if self.defines is None:
+            self.analyze()
+        if self.defines and self.reusable:
+            return Symbols()
+        return None
+
+    def eval(self, opt, scope, args=None, frame=None):
+        if self.block is None:
+            return None
+        if self.defines is None:
+            self.analyze()
+        # Function bodies, which get args, always have a frame of their own
+        # so that the scope depth limit sees every call
+        if not (opt or args is not None or self.defines):
+            return self.eval_stmts(opt, scope)
+
+        if frame is not None:
+            frame.clear()
+        scope.push(frame)
+        try:
+            if args:
+                for name, value in args.items():
+                    scope.add(name, value)
+            value = self.eval_stmts(opt, scope)
+        finally:
+            scope.pop()
         symbols = scope.last_pop
 
         if opt:
@@ -45,8 +108,12 @@ class Block(Node):
                     unused.append(sym)
             to_remove = []
             for stmt in self.block:
-                if isinstance(stmt, (Define, Fn)) and stmt.symbol in unused:
-                    to_remove.append(stmt)
+                if not isinstance(stmt, (Define, Fn)) or stmt.symbol not in unused:
+                    continue
+                # Calls and prints in the value still have to happen
+                if isinstance(stmt, Define) and has_effects(stmt.value):
+                    continue
+                to_remove.append(stmt)
             if to_remove:
                 print(f"Removing {len(to_remove)} unused definitions")
             for r in to_remove:
@@ -54,46 +121,86 @@ class Block(Node):
 
         return value
 
-    def draw(self, g):
-        g.node(self.id(), "Block")
-        if self.block:
+    def eval_stmts(self, opt, scope):
+        """Evaluate statements in the innermost frame of scope."""
+        value = None
+        if self.block is not None:
             for stmt in self.block:
-                g.edge(self.id(), stmt.draw(g))
-        return self.id()
+                value = stmt.eval(opt, scope)
+        return value
 
 
 class Statement(Node):
+    fields = ("stmt",)
+
     def __init__(self, stmt):
         self.stmt = stmt
 
     def eval(self, opt, scope):
         return self.stmt.eval(opt, scope)
 
-    def draw(self, g):
-        g.node(self.id(), "Statement")
-        g.edge(self.id(), self.stmt.draw(g))
-        return self.id()
+
+class LazyBlock:
+    """Parses the pending body of a function when its block is first read.
+
+    The block is then stored on the function itself, which takes precedence
+    over this descriptor, so later reads cost nothing extra.
+    """
+
+    def __get__(self, fn, owner=None):
+        if fn is None:
+            return self
+        block = fn.__dict__["block"] = fn.body.parse()
+        fn.body = None
+        return block
 
 
 class Fn(Node):
-    def __init__(self, symbol, args, block):
+    fields = ("symbol", "args", "block")
+
+    block = LazyBlock()
+    # Unparsed body, see lang.parser.Body
+    body = None
+    # Created on first definition
+    scope = None
+
+    def __init__(self, symbol, args, block, body=None):
         self.symbol = symbol
         self.args = args
-        self.block = block
-        self.scope = Scope()
+        if body is None:
+            self.block = block
+        else:
+            self.body = body
+
+    def __getstate__(self):
+        # The parser kept by a pending body cannot be pickled
+        self.block
+        return self.__dict__
 
     def eval(self, opt, scope):
+        if self.scope is None:
+            self.scope = Scope()
         self.scope.symbols_stack = scope.symbols_stack[:]
+        self.scope.limits = scope.limits
+        self.scope.memo = scope.memo
+        self.scope.numeric = scope.numeric
+        if scope.memo is not None:
+            scope.memo.define(self)
         scope.add(self.symbol, self)
 
-    def draw(self, g):
-        g.node(self.id(), "Define Fn: " + self.symbol)
-        g.edge(self.id(), self.args.draw(g), "Args")
-        g.edge(self.id(), self.block.draw(g), "Block")
-        return self.id()
+    def call(self, args):
+        """Evaluate the body with the parameters bound to args."""
+        if self.scope.numeric is not None:
+            return self.scope.numeric.call(self, args)
+        return self.block.eval(False, self.scope, args)
+
+    def label(self):
+        return "Define Fn: " + self.symbol
 
 
 class FnArg(Node):
+    fields = ("symbol", "type")
+
     def __init__(self, symbol, type):
         self.symbol = symbol
         self.type = type
@@ -101,13 +208,13 @@ class FnArg(Node):
     def eval(self, opt, scope):
         return self.symbol, self.type
 
-    def draw(self, g):
-        g.node(self.id(), "Arg: " + self.symbol)
-        g.edge(self.id(), self.type.draw(g), "Type")
-        return self.id()
+    def label(self):
+        return "Arg: " + self.symbol
 
 
 class FnArgs(Node):
+    fields = ("args",)
+
     def __init__(self, args):
         self.args = args
 
@@ -117,14 +224,10 @@ class FnArgs(Node):
             args.append(a.eval(opt, scope))
         return args
 
-    def draw(self, g):
-        g.node(self.id(), "FnArgs")
-        for a in self.args:
-            g.edge(self.id(), a.draw(g))
-        return self.id()
-
 
 class Define(Node):
+    fields = ("symbol", "value")
+
     def __init__(self, symbol, value):
         self.symbol = symbol
         self.value = value
@@ -133,13 +236,13 @@ class Define(Node):
         scope.add(self.symbol, self.value.eval(opt, scope))
         return None
 
-    def draw(self, g):
-        g.node(self.id(), "Define: " + self.symbol)
-        g.edge(self.id(), self.value.draw(g))
-        return self.id()
+    def label(self):
+        return "Define: " + self.symbol
 
 
 class Assign(Node):
+    fields = ("symbol", "value")
+
     def __init__(self, symbol, value):
         self.symbol = symbol
         self.value = value
@@ -148,13 +251,39 @@ class Assign(Node):
         scope.set(self.symbol, self.value.eval(opt, scope))
         return None
 
-    def draw(self, g):
-        g.node(self.id(), "Assign: " + self.symbol)
-        g.edge(self.id(), self.value.draw(g))
-        return self.id()
+    def label(self):
+        return "Assign: " + self.symbol
+
+
+class Append(Assign):
+    """Assignment of the form `s = s + value`.
+
+    While both sides are strings the variable is backed by a StrBuilder, so
+    building a string in a loop takes linear instead of quadratic time.
+    """
+
+    def eval(self, opt, scope):
+        symbols = scope.find(self.symbol)
+        if opt or not isinstance(symbols.symbols[self.symbol], (str, StrBuilder)):
+            return super().eval(opt, scope)
+
+        symbols.used[self.symbol] = True
+        value = self.value.right.eval(opt, scope)
+        if not isinstance(value, str):
+            return super().eval(opt, scope)
+
+        builder = symbols.append(self.symbol, value)
+        if scope.limits is not None:
+            scope.limits.check_str(builder)
+        return None
+
+    def label(self):
+        return "Append: " + self.symbol
 
 
 class Print(Node):
+    fields = ("value", "newline")
+
     def __init__(self, value, newline):
         self.value = value
         self.newline = newline
@@ -169,80 +298,79 @@ class Print(Node):
                 print(self.value.eval(opt, scope), end="")
         return None
 
-    def draw(self, g):
-        newline = "ln" if self.newline else ""
-        g.node(self.id(), "Print" + newline)
-        g.edge(self.id(), self.value.draw(g))
-        return self.id()
+    def label(self):
+        return "Println" if self.newline else "Print"
 
 
 class ValueInt(Node):
+    fields = ("value",)
+
     def __init__(self, value):
         self.value = value
 
     def eval(self, opt, scope):
         return self.value
 
-    def draw(self, g):
-        g.node(self.id(), "ValueInt: " + str(self.value))
-        return self.id()
+    def label(self):
+        return "ValueInt: " + str(self.value)
 
 
 class ValueFloat(Node):
+    fields = ("value",)
+
     def __init__(self, value):
         self.value = value
 
     def eval(self, opt, scope):
         return self.value
 
-    def draw(self, g):
-        g.node(self.id(), "ValueFloat: " + str(self.value))
-        return self.id()
+    def label(self):
+        return "ValueFloat: " + str(self.value)
 
 
 class ValueStr(Node):
+    fields = ("value",)
+
     def __init__(self, value):
         self.value = value[1:-1]
 
     def eval(self, opt, scope):
         return self.value
 
-    def draw(self, g):
-        g.node(self.id(), "ValueStr: " + self.value)
-        return self.id()
+    def label(self):
+        return "ValueStr: " + self.value
 
 
 class ValueTrue(Node):
+    fields = ()
+
     def eval(self, opt, scope):
         return True
 
-    def draw(self, g):
-        g.node(self.id(), "ValueTrue")
-        return self.id()
-
 
 class ValueFalse(Node):
+    fields = ()
+
     def eval(self, opt, scope):
         return False
 
-    def draw(self, g):
-        g.node(self.id(), "ValueFalse")
-        return self.id()
-
 
 class ValueSymbol(Node):
+    fields = ("symbol",)
+
     def __init__(self, symbol):
         self.symbol = symbol
 
     def eval(self, opt, scope):
         return scope.get(self.symbol)
 
-    def draw(self, g):
-        g.node(self.id(), "ValueSymbol: " + self.symbol)
-        return self.id()
+    def label(self):
+        return "ValueSymbol: " + self.symbol
 
 
 class Type(Node):
+    fields = ("type",)
+
     def __init__(self, type):
         types = {
             "INT": int,
@@ -256,12 +384,13 @@ class Type(Node):
     def eval(self, opt, scope):
         return self.type
 
-    def draw(self, g):
-        g.node(self.id(), "Type: " + self.type.__name__)
-        return self.id()
+    def label(self):
+        return "Type: " + self.type.__name__
 
 
 class BinaryOp(Node):
+    fields = ("op", "left", "right")
+
     def __init__(self, op, left, right):
         self.op = op
         self.left = left
@@ -270,6 +399,8 @@ class BinaryOp(Node):
     def eval(self, opt, scope):
         left = self.left.eval(opt, scope)
         right = self.right.eval(opt, scope)
+        if opt and (left is None or right is None):
+            return None
 
         if not isinstance(left, type(right)):
             if isinstance(left, int) and isinstance(right, float):
@@ -282,22 +413,23 @@ class BinaryOp(Node):
         elif isinstance(left, ValueStr) and self.op is not operator.add:
             raise ValueError("Invalid string operation")
         else:
-            return self.op(left, right)
+            value = self.op(left, right)
+            if isinstance(value, str) and scope.limits is not None:
+                scope.limits.check_str(value)
+            return value
 
-    def draw(self, g):
-        g.node(self.id(), "BinaryOp: " + self.op.__name__)
-        g.edge(self.id(), self.left.draw(g), "Left")
-        g.edge(self.id(), self.right.draw(g), "Right")
-        return self.id()
+    def label(self):
+        return "BinaryOp: " + self.op.__name__
 
 
 class If(Node):
+    fields = ("cond", "block")
+
     def __init__(self, cond, block):
         self.cond = cond
         self.block = block
 
     def eval(self, opt, scope):
-        scope.push()
         value = None
         if opt:
             self.cond.eval(opt, scope)
@@ -305,70 +437,67 @@ class If(Node):
         else:
             if self.cond.eval(opt, scope):
                 value = self.block.eval(opt, scope)
-        scope.pop()
         return value
 
-    def draw(self, g):
-        g.node(self.id(), "If")
-        g.edge(self.id(), self.cond.draw(g), "Condition")
-        g.edge(self.id(), self.block.draw(g), "Consequence")
-        return self.id()
-
 
 class IfElse(Node):
+    fields = ("cond", "true_block", "false_block")
+
     def __init__(self, cond, true_block, false_block):
         self.cond = cond
         self.true_block = true_block
         self.false_block = false_block
 
     def eval(self, opt, scope):
-        scope.push()
         value = None
         if opt:
             self.cond.eval(opt, scope)
-            self.true_block.eval(opt, scope)
-            self.false_block.eval(opt, scope)
+            # Either value will do for the expression using it
+            value = self.true_block.eval(opt, scope)
+            other = self.false_block.eval(opt, scope)
+            if value is None:
+                value = other
         else:
             if self.cond.eval(opt, scope):
                 value = self.true_block.eval(opt, scope)
             else:
                 value = self.false_block.eval(opt, scope)
-        scope.pop()
         return value
 
-    def draw(self, g):
-        g.node(self.id(), "IfElse")
-        g.edge(self.id(), self.cond.draw(g), "Condition")
-        g.edge(self.id(), self.true_block.draw(g), "Consequence")
-        g.edge(self.id(), self.false_block.draw(g), "Alternative")
-        return self.id()
-
 
 class While(Node):
+    fields = ("cond", "block")
+
     def __init__(self, cond, block):
         self.cond = cond
         self.block = block
 
     def eval(self, opt, scope):
-        scope.push()
+        if not opt and scope.numeric is not None:
+            return scope.numeric.loop(self, scope)
+        return self.run(opt, scope)
+
+    def run(self, opt, scope):
         value = None
         if opt:
             self.cond.eval(opt, scope)
             self.block.eval(opt, scope)
         else:
+            limits = scope.limits
+            frame = self.block.loop_frame()
             while self.cond.eval(opt, scope):
-                value = self.block.eval(opt, scope)
-        scope.pop()
+                if limits is not None:
+                    # Inlined Limits.tick, this runs on every loop back-edge
+                    limits.steps += 1
+                    if limits.steps >= limits.next_check:
+                        limits.check()
+                value = self.block.eval(opt, scope, frame=frame)
         return value
 
-    def draw(self, g):
-        g.node(self.id(), "While")
-        g.edge(self.id(), self.cond.draw(g), "Condition")
-        g.edge(self.id(), self.block.draw(g), "Consequence")
-        return self.id()
-
 
 class For(Node):
+    fields = ("begin", "cond", "step", "block")
+
     def __init__(self, begin, cond, step, block):
         self.begin = begin
         self.cond = cond
@@ -376,80 +505,97 @@ class For(Node):
         self.block = block
 
     def eval(self, opt, scope):
-        scope.push()
-        self.begin.eval(opt, scope)
-        value = None
-        if opt:
-            self.cond.eval(opt, scope)
-            self.block.eval(opt, scope)
-            self.step.eval(opt, scope)
-        else:
-            while self.cond.eval(opt, scope):
-                value = self.block.eval(opt, scope)
+        if not opt and scope.numeric is not None:
+            return scope.numeric.loop(self, scope)
+        return self.run(opt, scope)
+
+    def run(self, opt, scope):
+        # Only a definition in the header needs a frame around the loop
+        push = isinstance(self.begin, (Define, Fn)) or isinstance(
+            self.step, (Define, Fn)
+        )
+        if push:
+            scope.push()
+        try:
+            self.begin.eval(opt, scope)
+            value = None
+            if opt:
+                self.cond.eval(opt, scope)
+                self.block.eval(opt, scope)
                 self.step.eval(opt, scope)
-        scope.pop()
+            else:
+                limits = scope.limits
+                frame = self.block.loop_frame()
+                while self.cond.eval(opt, scope):
+                    if limits is not None:
+                        # Inlined Limits.tick, this runs on every loop back-edge
+                        limits.steps += 1
+                        if limits.steps >= limits.next_check:
+                            limits.check()
+                    value = self.block.eval(opt, scope, frame=frame)
+                    self.step.eval(opt, scope)
+        finally:
+            if push:
+                scope.pop()
         return value
 
-    def draw(self, g):
-        g.node(self.id(), "For")
-        g.edge(self.id(), self.begin.draw(g), "Begin")
-        g.edge(self.id(), self.cond.draw(g), "Condition")
-        g.edge(self.id(), self.step.draw(g), "Step")
-        g.edge(self.id(), self.block.draw(g), "Consequnce")
-        return self.id()
-
 
 class Minus(Node):
+    fields = ("value",)
+
     def __init__(self, value):
         self.value = value
 
     def eval(self, opt, scope):
         value = self.value.eval(opt, scope)
+        if opt and value is None:
+            return None
         if not isinstance(value, int) and not isinstance(value, float):
             type = value.__class__.__name__
             raise ValueError(f"Cannot negate {type}")
         return value * -1
 
-    def draw(self, g):
-        g.node(self.id(), "Unary minus")
-        g.edge(self.id(), self.value.draw(g))
-        return self.id()
+    def label(self):
+        return "Unary minus"
 
 
 class Not(Node):
+    fields = ("value",)
+
     def __init__(self, value):
         self.value = value
 
     def eval(self, opt, scope):
         value = self.value.eval(opt, scope)
+        if opt and value is None:
+            return None
         if not isinstance(value, bool):
             type = value.__class__.__name__
             raise ValueError(f"Cannot negate {type}")
         return not value
 
-    def draw(self, g):
-        g.node(self.id(), "Negate")
-        g.edge(self.id(), self.value.draw(g))
-        return self.id()
+    def label(self):
+        return "Negate"
 
 
 class Cast(Node):
+    fields = ("type", "value")
+
     def __init__(self, type, value):
         self.type = type
         self.value = value
 
     def eval(self, opt, scope):
         cast = self.type.eval(opt, scope)
-        return cast(self.value.eval(opt, scope))
-
-    def draw(self, g):
-        g.node(self.id(), "Cast")
-        g.edge(self.id(), self.type.draw(g), "Type")
-        g.edge(self.id(), self.value.draw(g), "Value")
-        return self.id()
+        value = self.value.eval(opt, scope)
+        if opt and value is None:
+            return None
+        return cast(value)
 
 
 class Args(Node):
+    fields = ("args",)
+
     def __init__(self, args):
         self.args = args
 
@@ -459,45 +605,194 @@ class Args(Node):
             args.append(a.eval(opt, scope))
         return args
 
-    def draw(self, g):
-        g.node(self.id(), "Args")
-        for a in self.args:
-            g.edge(self.id(), a.draw(g))
-        return self.id()
-
 
 class Call(Node):
+    fields = ("symbol", "args")
+
+    # Inline cache of the last lookup, see resolve()
+    cache = None
+
     def __init__(self, symbol, args):
         self.symbol = symbol
         self.args = args
 
-    def eval(self, opt, scope):
-        builtin = {"sin": math.sin, "cos": math.cos, "pi": lambda: math.pi}
+    def resolve(self, scope):
+        """Return the called function and its parameters as (name, type)
+        pairs.
+
+        The frame the function was found in is remembered together with the
+        version of its name. While the same frame is at the same position of
+        the stack and no frame has bound the name since, the lookup would
+        give the same result. The frame is only referenced weakly, so a
+        parsed program which is run again does not keep the variables of
+        its previous run alive.
+        """
+        stack = scope.symbols_stack
+        cache = self.cache
+        if cache is not None:
+            version, index, frame, fn, params = cache
+            if (
+                version == versions[self.symbol]
+                and index < len(stack)
+                and stack[index] is frame()
+            ):
+                return fn, params
+
+        version = versions.setdefault(self.symbol, 0)
+        for index, frame in enumerate(stack):
+            if frame.contains(self.symbol):
+                fn = frame.get(self.symbol)
+                break
+        else:
+            raise ValueError(f"Undefined identifier '{self.symbol}'")
+
+        params = [(arg.symbol, arg.type.type) for arg in fn.args.args]
+        self.cache = (version, index, weakref.ref(frame), fn, params)
+        return fn, params
 
+    def __getstate__(self):
+        # The cached frame belongs to the current run
+        state = dict(self.__dict__)
+        state.pop("cache", None)
+        return state
+
+    def eval(self, opt, scope):
         evaled = self.args.eval(opt, scope)
 
-        if self.symbol in builtin:
-            return builtin[self.symbol](*evaled)
+        if self.symbol in BUILTINS:
+            if opt and None in evaled:
+                return None
+            return BUILTINS[self.symbol](*evaled)
 
-        fn = scope.get(self.symbol)
-        types = fn.args.eval(opt, scope)
-        if len(evaled) != len(types):
+        if opt:
+            # Lookups mark definitions as used, so they cannot be skipped
+            fn = scope.get(self.symbol)
+            params = [(arg.symbol, arg.type.type) for arg in fn.args.args]
+        else:
+            fn, params = self.resolve(scope)
+        if len(evaled) != len(params):
             raise ValueError(f"Invalid number of arguments passed to '{self.symbol}'")
 
         args = {}
-        for i in range(len(types)):
-            value = evaled[i]
-            name, expected_type = types[i]
-            expected_type = expected_type.eval(opt, scope)
+        for (name, expected_type), value in zip(params, evaled):
+            if type(value) is expected_type or (opt and value is None):
+                args[name] = value
+                continue
             try:
                 args[name] = expected_type(value)
             except ValueError:
                 raise ValueError(
                     f"Cannot convert '{value}' to {str(expected_type.__name__)}"
                 )
-        return fn.block.eval(opt, fn.scope, args)
+        if fn.scope.limits is not None:
+            fn.scope.limits.tick()
+
+        if opt:
+            if fn in walking:
+                return None
+            walking.add(fn)
+            try:
+                return fn.block.eval(opt, fn.scope, args)
+            finally:
+                walking.discard(fn)
+
+        memo = fn.scope.memo
+        if memo is not None:
+            cache = memo.cache(fn)
+            if cache is not None:
+                key = tuple(args.values())
+                value = cache.get(key, cache)
+                if value is cache:
+                    value = fn.call(args)
+                    cache.put(key, value)
+                return value
+
+        return fn.call(args)
+
+    def label(self):
+        return "Call: " + self.symbol
+
+
+class Inline(Node):
+    """Body of a small function substituted for a call by the optimizer.
+
+    Arguments are converted to the parameter types the same way Call does and
+    passed to the body through Temp nodes named after the parameters.
+    """
+
+    fields = ("symbol", "params", "args", "body")
+
+    def __init__(self, symbol, params, args, body):
+        self.symbol = symbol
+        self.params = params
+        self.args = args
+        self.body = body
+
+    def eval(self, opt, scope):
+        evaled = self.args.eval(opt, scope)
+        values = []
+        for param, value in zip(self.params.args, evaled):
+            expected_type = param.type.type
+            try:
+                values.append(expected_type(value))
+            except ValueError:
+                raise ValueError(
+                    f"Cannot convert '{value}' to {str(expected_type.__name__)}"
+                )
+        if scope.limits is not None:
+            scope.limits.tick()
+
+        temps = scope.temps
+        for param, value in zip(self.params.args, values):
+            temps.setdefault(param.symbol, []).append(value)
+        try:
+            return self.body.eval(opt, scope)
+        finally:
+            for param in self.params.args:
+                temps[param.symbol].pop()
+
+    def label(self):
+        return "Inline: " + self.symbol
+
+
+class Bind(Node):
+    """Makes value available to Temp nodes of the same name inside body.
+
+    The value is computed when the first Temp is evaluated, so it runs at the
+    same point as the first occurrence of the expression it replaces.
+    """
+
+    fields = ("name", "value", "body")
+
+    def __init__(self, name, value, body):
+        self.name = name
+        self.value = value
+        self.body = body
+
+    def eval(self, opt, scope):
+        stack = scope.temps.setdefault(self.name, [])
+        stack.append(self)
+        try:
+            return self.body.eval(opt, scope)
+        finally:
+            stack.pop()
+
+    def label(self):
+        return "Bind: " + self.name
+
+
+class Temp(Node):
+    fields = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def eval(self, opt, scope):
+        stack = scope.temps[self.name]
+        value = stack[-1]
+        if isinstance(value, Bind):
+            value = stack[-1] = value.value.eval(opt, scope)
+        return value
 
-    def draw(self, g):
-        g.node(self.id(), "Call: " + self.symbol)
-        g.edge(self.id(), self.args.draw(g), "Args")
-        return self.id()
+    def label(self):
+        return "Temp: " + self.name
@@ -0,0 +1,176 @@
+"""Static checks of a parsed script, used by --check.
+
+Every function body is checked whether it is called or not. Reported are
+identifiers defined nowhere in the enclosing blocks, calls with a wrong
+number of arguments and operations or assignments which always fail because
+of their operand types. Types are only followed where they are certain, so
+a script passing the check may still fail at runtime.
+"""
+
+import operator
+
+from lang import ast
+
+COMPARISONS = {
+    operator.eq,
+    operator.ne,
+    operator.le,
+    operator.ge,
+    operator.lt,
+    operator.gt,
+}
+
+LITERALS = {
+    ast.ValueInt: int,
+    ast.ValueFloat: float,
+    ast.ValueStr: str,
+    ast.ValueTrue: bool,
+    ast.ValueFalse: bool,
+}
+
+
+class Checker:
+    def __init__(self):
+        self.errors = []
+        # Names of the functions being checked, innermost last
+        self.functions = []
+
+    def check(self, program):
+        self.block(program.block, [{}])
+        return self.errors
+
+    def error(self, message):
+        if self.functions:
+            message = f"In '{self.functions[-1]}': {message}"
+        self.errors.append(message)
+
+    def lookup(self, name, env):
+        for frame in reversed(env):
+            if name in frame:
+                return frame[name]
+        self.error(f"Undefined identifier '{name}'")
+        return None
+
+    @staticmethod
+    def declare(stmts, frame):
+        # Functions see definitions made after them, so declare every name
+        # of the frame up front with an unknown type
+        for stmt in stmts:
+            if isinstance(stmt, (ast.Define, ast.Fn)):
+                frame.setdefault(stmt.symbol, None)
+
+    def block(self, block, env):
+        if block.block is None:
+            return
+        self.declare(block.block, env[-1])
+        for stmt in block.block:
+            self.visit(stmt, env)
+
+    def visit(self, node, env):
+        """Check node and return the type of its value, if certain."""
+        if type(node) in LITERALS:
+            return LITERALS[type(node)]
+
+        elif isinstance(node, ast.ValueSymbol):
+            value = self.lookup(node.symbol, env)
+            return value if isinstance(value, type) else None
+
+        elif isinstance(node, ast.Block):
+            self.block(node, env + [{}])
+
+        elif isinstance(node, ast.Fn):
+            env[-1][node.symbol] = node
+            params = {arg.symbol: arg.type.type for arg in node.args.args}
+            self.functions.append(node.symbol)
+            self.block(node.block, env + [params])
+            self.functions.pop()
+
+        elif isinstance(node, ast.Define):
+            env[-1][node.symbol] = self.visit(node.value, env)
+
+        elif isinstance(node, ast.Assign):
+            value = self.visit(node.value, env)
+            variable = self.lookup(node.symbol, env)
+            if (
+                isinstance(variable, type)
+                and value is not None
+                and not issubclass(variable, value)
+            ):
+                self.error(
+                    f"Cannot assign {node.symbol} of type {value.__name__} "
+                    f"to variable of type {variable.__name__}"
+                )
+
+        elif isinstance(node, ast.BinaryOp):
+            return self.binary_op(node, env)
+
+        elif isinstance(node, ast.Minus):
+            value = self.visit(node.value, env)
+            if value is str:
+                self.error("Cannot negate str")
+            return value
+
+        elif isinstance(node, ast.Not):
+            value = self.visit(node.value, env)
+            if value is not None and value is not bool:
+                self.error(f"Cannot negate {value.__name__}")
+            return bool
+
+        elif isinstance(node, ast.Cast):
+            self.visit(node.value, env)
+            return node.type.type
+
+        elif isinstance(node, ast.For):
+            env = env + [{}]
+            self.declare([node.begin, node.step], env[-1])
+            for child in (node.begin, node.cond, node.block, node.step):
+                self.visit(child, env)
+
+        elif isinstance(node, ast.Call):
+            self.visit(node.args, env)
+            if node.symbol in ast.BUILTINS:
+                return float
+            fn = self.lookup(node.symbol, env)
+            if isinstance(fn, ast.Fn) and len(fn.args.args) != len(node.args.args):
+                self.error(
+                    f"Invalid number of arguments passed to '{node.symbol}'"
+                )
+
+        else:
+            for child in node.children():
+                self.visit(child, env)
+
+        return None
+
+    def binary_op(self, node, env):
+        left = self.visit(node.left, env)
+        right = self.visit(node.right, env)
+        if left is None or right is None:
+            return bool if node.op in COMPARISONS else None
+
+        # Mirrors the checks of BinaryOp.eval
+        if not issubclass(left, right) and not (
+            (issubclass(left, int) and right is float)
+            or (left is float and issubclass(right, int))
+        ):
+            ltype = node.left.__class__.__name__
+            rtype = node.right.__class__.__name__
+            self.error(f"Type mismatch between {ltype} and {rtype}")
+            return None
+
+        if node.op in COMPARISONS:
+            return bool
+        if left is str:
+            return str if node.op is operator.add else None
+        if node.op is operator.truediv or float in (left, right):
+            return float
+        if node.op in (operator.and_, operator.or_) and left is right is bool:
+            return bool
+        if node.op is operator.pow:
+            # Negative exponents give a float
+            return None
+        return int
+
+
+def check(program):
+    return Checker().check(program)
@@ -0,0 +1,240 @@
+"""Streaming AST dumps in text, JSON and DOT formats.
+
+Nodes are written while the tree is walked, so memory use does not grow with
+the size of the program. The walk keeps its own stack instead of recursing,
+so deeply nested expressions can be dumped too. Every occurrence of a node
+gets the next sequential id, which keeps the output stable between runs and
+shows shared subtrees once per parent.
+"""
+
+import json
+import os
+import sys
+
+from lang.ast import Node
+
+
+class TextWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def begin(self):
+        pass
+
+    def enter(self, id, label, parent, edge, depth, repeat):
+        line = "  " * depth
+        if edge is not None:
+            line += edge + ": "
+        line += f"#{id} {label}"
+        if repeat > 1:
+            line += f" (x{repeat})"
+        self.out.write(line + "\n")
+
+    def leave(self, id):
+        pass
+
+    def end(self):
+        pass
+
+
+def string(text):
+    # Non-ASCII characters are written as they are instead of escaped
+    return json.dumps(text, ensure_ascii=False)
+
+
+class JsonWriter:
+    def __init__(self, out):
+        self.out = out
+        self.first = [True]
+
+    def begin(self):
+        pass
+
+    def enter(self, id, label, parent, edge, depth, repeat):
+        if not self.first[-1]:
+            self.out.write(",")
+        self.first[-1] = False
+        self.first.append(True)
+
+        self.out.write(f'{{"id": {id}, "label": {string(label)}')
+        if edge is not None:
+            self.out.write(f', "edge": {string(edge)}')
+        if repeat > 1:
+            self.out.write(f', "repeat": {repeat}')
+        self.out.write(', "children": [')
+
+    def leave(self, id):
+        self.first.pop()
+        self.out.write("]}")
+
+    def end(self):
+        self.out.write("\n")
+
+
+def quote(text):
+    """Return text as a DOT string, which keeps non-ASCII characters."""
+    text = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{text}"'
+
+
+class DotWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def begin(self):
+        self.out.write("digraph AST {\n")
+
+    def enter(self, id, label, parent, edge, depth, repeat):
+        if repeat > 1:
+            label += f" (x{repeat})"
+        self.out.write(f"  n{id} [label={quote(label)}];\n")
+        if parent is not None:
+            self.out.write(f"  n{parent} -> n{id}")
+            if edge is not None:
+                self.out.write(f" [label={quote(edge)}]")
+            self.out.write(";\n")
+
+    def leave(self, id):
+        pass
+
+    def end(self):
+        self.out.write("}\n")
+
+
+WRITERS = {"text": TextWriter, "json": JsonWriter, "dot": DotWriter}
+
+
+def edges(node):
+    for name in node.fields:
+        value = getattr(node, name)
+        if isinstance(value, Node):
+            yield name, value
+        elif isinstance(value, list):
+            yield name, value
+
+
+def same_shape(a, b):
+    pairs = [(a, b)]
+    while pairs:
+        a, b = pairs.pop()
+        if a is b:
+            continue
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, Node):
+            pairs.extend((getattr(a, name), getattr(b, name)) for name in a.fields)
+        elif isinstance(a, list):
+            if len(a) != len(b):
+                return False
+            pairs.extend(zip(a, b))
+        elif a != b:
+            return False
+    return True
+
+
+# Kinds of work items on the stack of Dumper.dump
+VISIT = 0
+VISIT_LIST = 1
+LEAVE = 2
+
+
+class Dumper:
+    def __init__(
+        self, writer, max_depth=None, max_children=None, max_nodes=None, collapse=True
+    ):
+        self.writer = writer
+        self.max_depth = max_depth
+        self.max_children = max_children
+        self.max_nodes = max_nodes
+        self.collapse = collapse
+        self.next_id = 0
+
+    def dump(self, node):
+        self.writer.begin()
+        # Items are taken from the end, so children are pushed in reverse
+        stack = [(VISIT, node, None, None, 0, 1)]
+        while stack:
+            item = stack.pop()
+            if item[0] == VISIT:
+                self.visit(stack, *item[1:])
+            elif item[0] == VISIT_LIST:
+                self.visit_list(stack, *item[1:])
+            else:
+                self.writer.leave(item[1])
+        self.writer.end()
+
+    def visit(self, stack, node, parent, edge, depth, repeat):
+        id = self.emit(node.label(), parent, edge, depth, repeat)
+        stack.append((LEAVE, id))
+
+        children = list(edges(node))
+        if children:
+            if self.max_depth is not None and depth >= self.max_depth:
+                self.placeholder("...", id, depth + 1)
+            elif self.max_nodes is not None and self.next_id >= self.max_nodes:
+                self.placeholder("...", id, depth + 1)
+            else:
+                for name, value in reversed(children):
+                    if isinstance(value, list):
+                        stack.append((VISIT_LIST, value, id, name, depth + 1, 0, 0))
+                    else:
+                        stack.append((VISIT, value, id, name, depth + 1, 1))
+
+    def visit_list(self, stack, nodes, parent, edge, depth, i, shown):
+        """Visit the nodes of a list from index i on, after shown groups of
+        them have been visited."""
+        if i >= len(nodes):
+            return
+        if self.max_children is not None and shown >= self.max_children:
+            self.placeholder(f"... {len(nodes) - i} more", parent, depth)
+            return
+        if self.max_nodes is not None and self.next_id >= self.max_nodes:
+            self.placeholder(f"... {len(nodes) - i} more", parent, depth)
+            return
+
+        repeat = 1
+        if self.collapse:
+            while i + repeat < len(nodes) and same_shape(nodes[i], nodes[i + repeat]):
+                repeat += 1
+        # The rest of the list follows once this node has been dumped
+        stack.append((VISIT_LIST, nodes, parent, edge, depth, i + repeat, shown + 1))
+        stack.append((VISIT, nodes[i], parent, edge, depth, repeat))
+
+    def placeholder(self, label, parent, depth):
+        id = self.emit(label, parent, None, depth, 1)
+        self.writer.leave(id)
+
+    def emit(self, label, parent, edge, depth, repeat):
+        id = self.next_id
+        self.next_id += 1
+        self.writer.enter(id, label, parent, edge, depth, repeat)
+        return id
+
+
+def dump(node, out, format="text", **options):
+    Dumper(WRITERS[format](out), **options).dump(node)
+
+
+def can_view():
+    if sys.platform in ("win32", "darwin"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def render(node, name="ast", view=None, **options):
+    import graphviz
+
+    source = name + ".gv"
+    output = name + ".png"
+    with open(source, "w", encoding="utf-8") as f:
+        dump(node, f, "dot", **options)
+    try:
+        graphviz.render("dot", "png", source, outfile=output)
+    finally:
+        os.remove(source)
+
+    if view is None:
+        view = can_view()
+    if view:
+        graphviz.view(output)
+    return output
@@ -0,0 +1,83 @@
+import time
+
+
+class LimitExceeded(Exception):
+    def __init__(self, message, stats):
+        super().__init__(message)
+        self.stats = stats
+
+    def __str__(self):
+        usage = ", ".join(f"{k}={v}" for k, v in self.stats.items())
+        return f"{self.args[0]} ({usage})"
+
+
+class Limits:
+    """Resource limits for a single run of the interpreter.
+
+    Steps are counted per loop iteration and per function call. The
+    wall-clock limit is only checked every `check_interval` steps to keep
+    the overhead low, so a run may overshoot it slightly. The step limit is
+    checked at the latest when it is reached.
+    """
+
+    def __init__(
+        self,
+        max_steps=None,
+        max_time=None,
+        max_str_len=None,
+        max_depth=None,
+        check_interval=1024,
+    ):
+        self.max_steps = max_steps
+        self.max_time = max_time
+        self.max_str_len = max_str_len
+        self.max_depth = max_depth
+        self.check_interval = check_interval
+        self.start()
+
+    def start(self):
+        self.steps = 0
+        self.max_depth_seen = 0
+        self.started = time.perf_counter()
+        self.schedule()
+
+    def schedule(self):
+        # A step limit below the interval is checked when it is reached
+        self.next_check = self.steps + self.check_interval
+        if self.max_steps is not None:
+            self.next_check = min(self.next_check, self.max_steps + 1)
+
+    def tick(self, steps=1):
+        self.steps += steps
+        if self.steps >= self.next_check:
+            self.check()
+
+    def check(self):
+        self.schedule()
+        if self.max_steps is not None and self.steps > self.max_steps:
+            self.exceeded(f"Step limit of {self.max_steps} exceeded")
+        if self.max_time is not None and self.elapsed() > self.max_time:
+            self.exceeded(f"Time limit of {self.max_time}s exceeded")
+
+    def check_str(self, value):
+        if self.max_str_len is not None and len(value) > self.max_str_len:
+            self.exceeded(f"String length limit of {self.max_str_len} exceeded")
+
+    def check_depth(self, depth):
+        if depth > self.max_depth_seen:
+            self.max_depth_seen = depth
+        if self.max_depth is not None and depth > self.max_depth:
+            self.exceeded(f"Scope depth limit of {self.max_depth} exceeded")
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def stats(self):
+        return {
+            "steps": self.steps,
+            "time": round(self.elapsed(), 6),
+            "depth": self.max_depth_seen,
+        }
+
+    def exceeded(self, message):
+        raise LimitExceeded(message, self.stats())
@@ -0,0 +1,174 @@
+"""Memoization of pure user-defined functions.
+
+A function is pure when its result depends only on its arguments: it does
+not print, define nested functions, read or assign variables from enclosing
+scopes, and only calls builtins and other pure functions. Callees are
+resolved in the scope the function was defined in. Binding a name which a
+checked function calls, by a definition or an assignment such as `f = g`,
+drops what is known about the functions calling it.
+"""
+
+from collections import OrderedDict
+
+from lang import ast
+
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Purity:
+    def __init__(self):
+        self.results = {}
+        self.checking = set()
+        # Results which relied on a function still being checked
+        self.pending = []
+        # Names of the functions called by each checked function
+        self.callees = {}
+        # Every name ever found in callees
+        self.called = set()
+
+    def is_pure(self, fn):
+        if fn in self.results:
+            return self.results[fn]
+        if fn in self.checking:
+            # Recursive call, assume pure until proven otherwise
+            return True
+
+        self.checking.add(fn)
+        self.callees[fn] = set()
+        env = [{arg.symbol for arg in fn.args.args}]
+        try:
+            pure = self.visit(fn.block, env, fn)
+        finally:
+            self.checking.discard(fn)
+        self.results[fn] = pure
+
+        if self.checking:
+            self.pending.append(fn)
+        else:
+            if not pure:
+                for f in self.pending:
+                    self.results.pop(f, None)
+            self.pending = []
+        return pure
+
+    def forget(self, fn):
+        self.results.pop(fn, None)
+        self.callees.pop(fn, None)
+
+    def visit(self, node, env, fn):
+        if isinstance(node, (ast.Print, ast.Fn)):
+            return False
+        elif isinstance(node, ast.Block):
+            env = env + [set()]
+            return all(self.visit(stmt, env, fn) for stmt in node.block or [])
+        elif isinstance(node, ast.For):
+            env = env + [set()]
+            return all(
+                self.visit(n, env, fn)
+                for n in (node.begin, node.cond, node.block, node.step)
+            )
+        elif isinstance(node, ast.Define):
+            if not self.visit(node.value, env, fn):
+                return False
+            env[-1].add(node.symbol)
+            return True
+        elif isinstance(node, (ast.Assign, ast.ValueSymbol)):
+            if not any(node.symbol in names for names in env):
+                return False
+        elif isinstance(node, ast.Call):
+            if not self.visit(node.args, env, fn):
+                return False
+            if node.symbol in ast.BUILTINS:
+                return True
+            if any(node.symbol in names for names in env):
+                return False
+            self.callees[fn].add(node.symbol)
+            self.called.add(node.symbol)
+            try:
+                callee = fn.scope.get(node.symbol)
+            except ValueError:
+                return False
+            return isinstance(callee, ast.Fn) and self.is_pure(callee)
+
+        return all(self.visit(child, env, fn) for child in node.children())
+
+
+class Memo:
+    """Caches the results of pure functions called during a run."""
+
+    def __init__(self, size=128):
+        self.size = size
+        self.purity = Purity()
+        self.caches = {}
+        # Statistics of caches dropped by define()
+        self.totals = {}
+
+    def cache(self, fn):
+        if fn in self.caches:
+            return self.caches[fn]
+        cache = LRUCache(self.size) if self.purity.is_pure(fn) else None
+        self.caches[fn] = cache
+        return cache
+
+    def define(self, fn):
+        """Drop what is known about fn and the functions calling it by name,
+        as a new definition may change which function a name refers to."""
+        self.drop({fn.symbol}, {fn})
+
+    def rebind(self, name):
+        """Drop what is known about the functions calling name, which now
+        refers to another value."""
+        if name in self.purity.called:
+            self.drop({name}, set())
+
+    def drop(self, names, stale):
+        changed = True
+        while changed:
+            changed = False
+            for f, callees in self.purity.callees.items():
+                if f not in stale and names & callees:
+                    stale.add(f)
+                    names.add(f.symbol)
+                    changed = True
+        for f in stale:
+            self.purity.forget(f)
+            cache = self.caches.pop(f, None)
+            if cache is not None:
+                self.count(f, cache)
+
+    def count(self, fn, cache):
+        add_stats(self.totals, fn.symbol, cache)
+
+    def stats(self):
+        stats = {name: dict(entry) for name, entry in self.totals.items()}
+        for fn, cache in self.caches.items():
+            if cache is not None:
+                add_stats(stats, fn.symbol, cache)
+        return stats
+
+
+def add_stats(stats, name, cache):
+    entry = stats.setdefault(name, {"hits": 0, "misses": 0})
+    entry["hits"] += cache.hits
+    entry["misses"] += cache.misses
@@ -0,0 +1,527 @@
+"""Typed execution of functions and loops using only ints and floats.
+
+A function whose parameters and local variables are all ints or floats is
+compiled on its first call into closures over array('q') and array('d')
+slots, one slot per variable. So is a loop whose variables are, the first
+time it is entered. The type of every expression is known when compiling,
+so the closures apply each operation directly, without the type checks and
+int to float promotion of BinaryOp.eval, and read and write variables by
+index instead of looking them up in the scope.
+
+Compiled code may use numbers, booleans in conditions, the builtins,
+arithmetic, comparisons, casts, blocks, ifs and loops. Anything else, such
+as strings, printing or calls of user functions, leaves the whole function
+or loop to the general interpreter. A function only sees its parameters and
+local variables. A loop also uses the variables of enclosing scopes, which
+must hold the types they had when it was compiled; it reads them when it
+starts and writes back the ones it assigns when it ends.
+
+Compiled code has no effects besides its own variables. A run ending in an
+error, including an int too large for a 64-bit slot, is therefore repeated
+from the start by the general interpreter, which gives the same output and
+error as if this tier had not been used. Exceeded limits are not repeated.
+
+Compiled code does not evaluate nodes, so it is not used while a
+lang.stats.Stats object is counting them.
+"""
+
+import operator
+from array import array
+
+from lang import ast, stats
+from lang.check import COMPARISONS
+from lang.limits import LimitExceeded
+
+NUMBERS = (int, float)
+
+SLOTS = {int: "q", float: "d"}
+
+
+class NotNumeric(Exception):
+    """Raised while compiling code the typed tier cannot run."""
+
+
+class Expr:
+    """Compiled expression: the type of its value, or None if it is not
+    known, and a closure computing the value.
+
+    Variables and literals also record where their value can be read
+    without a call, which lets operations on them skip a closure.
+    """
+
+    def __init__(self, type, fn, slots=None, index=None, literal=False, value=None):
+        self.type = type
+        self.fn = fn
+        self.slots = slots
+        self.index = index
+        self.literal = literal
+        self.value = value
+
+
+def variable(type, slots, index):
+    return Expr(type, lambda: slots[index], slots=slots, index=index)
+
+
+def literal(value):
+    return Expr(type(value), lambda: value, literal=True, value=value)
+
+
+def apply(op, left, right):
+    """Closure computing op(left, right), reading variable and literal
+    operands in place."""
+    if left.slots is not None and right.slots is not None:
+        ls, li, rs, ri = left.slots, left.index, right.slots, right.index
+        return lambda: op(ls[li], rs[ri])
+    if left.slots is not None and right.literal:
+        ls, li, c = left.slots, left.index, right.value
+        return lambda: op(ls[li], c)
+    if left.literal and right.slots is not None:
+        c, rs, ri = left.value, right.slots, right.index
+        return lambda: op(c, rs[ri])
+    if right.literal:
+        lf, c = left.fn, right.value
+        return lambda: op(lf(), c)
+    if left.slots is not None:
+        ls, li, rf = left.slots, left.index, right.fn
+        return lambda: op(ls[li], rf())
+    lf, rf = left.fn, right.fn
+    return lambda: op(lf(), rf())
+
+
+def sequence(fns):
+    """Closure running fns in order and returning the value of the last."""
+    if not fns:
+        return lambda: None
+    if len(fns) == 1:
+        return fns[0]
+    *init, last = fns
+
+    def run():
+        for fn in init:
+            fn()
+        return last()
+
+    return run
+
+
+class Kernel:
+    """Compiled function or loop together with the slots of its variables."""
+
+    def __init__(self):
+        self.slots = {type_: array(code) for type_, code in SLOTS.items()}
+        # Limits of the run in progress, read by the compiled loops
+        self.limits = None
+        # Slots of the parameters of a function, in order
+        self.params = []
+        # Variables of enclosing scopes used by a loop, with their slots
+        self.free = {}
+        # Names of the enclosing variables a loop assigns to
+        self.assigned = set()
+        self.run = None
+
+    def load(self, scope):
+        """Copy the enclosing variables of a loop into their slots, or
+        return False if one no longer has the type it was compiled for."""
+        for name, (type_, index) in self.free.items():
+            value = scope.get(name)
+            if type(value) is not type_:
+                return False
+            self.slots[type_][index] = value
+        return True
+
+    def store(self, scope):
+        for name in self.assigned:
+            type_, index = self.free[name]
+            scope.set(name, self.slots[type_][index])
+
+
+class Compiler:
+    def __init__(self, kernel, scope=None):
+        self.kernel = kernel
+        # Scope the enclosing variables of a loop are read from
+        self.scope = scope
+        # Variables visible at the current point, innermost last
+        self.frames = [{}]
+
+    def function(self, fn):
+        frame = self.frames[-1]
+        for arg in fn.args.args:
+            type_ = arg.type.type
+            if type_ not in NUMBERS or arg.symbol in frame:
+                raise NotNumeric()
+            frame[arg.symbol] = self.allocate(type_)
+            self.kernel.params.append(frame[arg.symbol])
+        # The body shares the frame of the parameters
+        return self.statements(fn.block)
+
+    def loop(self, loop):
+        # The first frame receives the enclosing variables found by lookup
+        return self.expr(loop).fn
+
+    def allocate(self, type_):
+        slots = self.kernel.slots[type_]
+        slots.append(0)
+        return type_, len(slots) - 1
+
+    def lookup(self, name):
+        for frame in reversed(self.frames):
+            if name in frame:
+                return frame[name]
+        if self.scope is None:
+            raise NotNumeric()
+        try:
+            value = self.scope.get(name)
+        except ValueError:
+            raise NotNumeric()
+        if type(value) not in NUMBERS:
+            raise NotNumeric()
+        var = self.frames[0][name] = self.allocate(type(value))
+        self.kernel.free[name] = var
+        return var
+
+    def statements(self, block):
+        if not block.block:
+            return Expr(None, lambda: None)
+        exprs = [self.expr(stmt) for stmt in block.block]
+        return Expr(exprs[-1].type, sequence([e.fn for e in exprs]))
+
+    def expr(self, node):
+        if isinstance(node, (ast.ValueInt, ast.ValueFloat)):
+            return literal(node.value)
+        elif isinstance(node, ast.ValueTrue):
+            return literal(True)
+        elif isinstance(node, ast.ValueFalse):
+            return literal(False)
+        elif isinstance(node, ast.ValueSymbol):
+            type_, index = self.lookup(node.symbol)
+            return variable(type_, self.kernel.slots[type_], index)
+        elif isinstance(node, ast.Statement):
+            return self.expr(node.stmt)
+        elif isinstance(node, ast.Block):
+            self.frames.append({})
+            try:
+                return self.statements(node)
+            finally:
+                self.frames.pop()
+        elif isinstance(node, ast.Define):
+            return self.define(node)
+        elif isinstance(node, ast.Assign):
+            return self.assign(node)
+        elif isinstance(node, ast.BinaryOp):
+            return self.binary_op(node)
+        elif isinstance(node, ast.Minus):
+            return self.minus(node)
+        elif isinstance(node, ast.Not):
+            value = self.expr(node.value)
+            if value.type is not bool:
+                raise NotNumeric()
+            fn = value.fn
+            return Expr(bool, lambda: not fn())
+        elif isinstance(node, ast.Cast):
+            return self.cast(node)
+        elif isinstance(node, ast.Call):
+            return self.call(node)
+        elif isinstance(node, ast.If):
+            return self.if_(node)
+        elif isinstance(node, ast.IfElse):
+            return self.if_else(node)
+        elif isinstance(node, ast.While):
+            return self.while_(node)
+        elif isinstance(node, ast.For):
+            return self.for_(node)
+        raise NotNumeric()
+
+    def define(self, node):
+        value = self.expr(node.value)
+        frame = self.frames[-1]
+        if value.type not in NUMBERS or node.symbol in frame:
+            raise NotNumeric()
+        type_, index = frame[node.symbol] = self.allocate(value.type)
+        return Expr(None, self.store(self.kernel.slots[type_], index, value))
+
+    def assign(self, node):
+        value = self.expr(node.value)
+        var = self.lookup(node.symbol)
+        type_, index = var
+        # Symbols.set refuses a value of another type
+        if value.type is not type_:
+            raise NotNumeric()
+        if self.kernel.free.get(node.symbol) is var:
+            self.kernel.assigned.add(node.symbol)
+        return Expr(None, self.store(self.kernel.slots[type_], index, value))
+
+    @staticmethod
+    def store(slots, index, value):
+        fn = value.fn
+
+        def run():
+            slots[index] = fn()
+
+        return run
+
+    def binary_op(self, node):
+        op = node.op
+        left = self.expr(node.left)
+        right = self.expr(node.right)
+
+        # Mirrors BinaryOp.eval, where bools only combine with bools
+        if left.type is bool or right.type is bool:
+            if left.type is not right.type or op not in (
+                operator.eq,
+                operator.ne,
+                operator.and_,
+                operator.or_,
+            ):
+                raise NotNumeric()
+            return Expr(bool, apply(op, left, right))
+        if left.type not in NUMBERS or right.type not in NUMBERS:
+            raise NotNumeric()
+
+        if op in (operator.and_, operator.or_):
+            if left.type is not int or right.type is not int:
+                raise NotNumeric()
+            type_ = int
+        elif op is operator.pow:
+            if left.type is float and right.type is int:
+                type_ = float
+            elif left.type is right.type is int and right.literal and right.value >= 0:
+                type_ = int
+            else:
+                # The result may be a float or a complex number
+                raise NotNumeric()
+        elif op in COMPARISONS:
+            type_ = bool
+        elif op is operator.truediv:
+            type_ = float
+        elif op in (operator.add, operator.sub, operator.mul, operator.mod):
+            type_ = float if float in (left.type, right.type) else int
+        else:
+            raise NotNumeric()
+
+        if left.type is not right.type:
+            if left.type is int:
+                left = self.to_float(left)
+            else:
+                right = self.to_float(right)
+        return Expr(type_, apply(op, left, right))
+
+    @staticmethod
+    def to_float(expr):
+        if expr.literal:
+            try:
+                return literal(float(expr.value))
+            except OverflowError:
+                raise NotNumeric()
+        fn = expr.fn
+        return Expr(float, lambda: float(fn()))
+
+    def minus(self, node):
+        value = self.expr(node.value)
+        if value.type not in NUMBERS:
+            raise NotNumeric()
+        return Expr(value.type, apply(operator.mul, value, literal(-1)))
+
+    def cast(self, node):
+        value = self.expr(node.value)
+        cast = node.type.type
+        if cast not in NUMBERS or value.type not in (int, float, bool):
+            raise NotNumeric()
+        fn = value.fn
+        return Expr(cast, lambda: cast(fn()))
+
+    def call(self, node):
+        if node.symbol not in ast.BUILTINS:
+            raise NotNumeric()
+        builtin = ast.BUILTINS[node.symbol]
+        args = [self.expr(arg) for arg in node.args.args]
+        if any(arg.type not in NUMBERS for arg in args):
+            raise NotNumeric()
+        fns = [arg.fn for arg in args]
+        if len(fns) == 1:
+            arg = fns[0]
+            # Like lang.check, builtins are taken to return floats
+            return Expr(float, lambda: builtin(arg()))
+        return Expr(float, lambda: builtin(*[f() for f in fns]))
+
+    def condition(self, node):
+        cond = self.expr(node)
+        if cond.type is None:
+            raise NotNumeric()
+        return cond.fn
+
+    def if_(self, node):
+        cond = self.condition(node.cond)
+        block = self.expr(node.block).fn
+
+        def run():
+            if cond():
+                return block()
+            return None
+
+        return Expr(None, run)
+
+    def if_else(self, node):
+        cond = self.condition(node.cond)
+        true_block = self.expr(node.true_block)
+        false_block = self.expr(node.false_block)
+        type_ = true_block.type if true_block.type is false_block.type else None
+        tf, ff = true_block.fn, false_block.fn
+        return Expr(type_, lambda: tf() if cond() else ff())
+
+    def while_(self, node):
+        cond = self.condition(node.cond)
+        block = self.expr(node.block).fn
+        kernel = self.kernel
+
+        def run():
+            value = None
+            limits = kernel.limits
+            while cond():
+                if limits is not None:
+                    limits.steps += 1
+                    if limits.steps >= limits.next_check:
+                        limits.check()
+                value = block()
+            return value
+
+        return Expr(None, run)
+
+    def for_(self, node):
+        # A definition in the step would be repeated in the same frame
+        if isinstance(node.step, ast.Define):
+            raise NotNumeric()
+        self.frames.append({})
+        try:
+            begin = self.expr(node.begin).fn
+            cond = self.condition(node.cond)
+            block = self.expr(node.block).fn
+            step = self.expr(node.step).fn
+        finally:
+            self.frames.pop()
+        kernel = self.kernel
+
+        def run():
+            begin()
+            value = None
+            limits = kernel.limits
+            while cond():
+                if limits is not None:
+                    limits.steps += 1
+                    if limits.steps >= limits.next_check:
+                        limits.check()
+                value = block()
+                step()
+            return value
+
+        return Expr(None, run)
+
+
+def compile_function(fn):
+    """Return a Kernel running the body of fn, or None if it cannot be run
+    on typed storage."""
+    kernel = Kernel()
+    try:
+        kernel.run = Compiler(kernel).function(fn).fn
+    except NotNumeric:
+        return None
+    return kernel
+
+
+def compile_loop(loop, scope):
+    """Return a Kernel running loop, which is about to be entered in scope,
+    or None if it cannot be run on typed storage."""
+    kernel = Kernel()
+    try:
+        kernel.run = Compiler(kernel, scope).loop(loop)
+    except NotNumeric:
+        return None
+    return kernel
+
+
+def usable(limits):
+    # Compiled code does not push frames, so it cannot track their depth,
+    # and it runs none of the evaluations statistics count
+    if stats.active is not None:
+        return False
+    return limits is None or limits.max_depth is None
+
+
+class Numeric:
+    """Runs functions and loops of one interpreter session on typed
+    storage where possible."""
+
+    def __init__(self):
+        self.functions = {}
+        self.loops = {}
+        # Runs of compiled code repeated by the general interpreter
+        self.fallbacks = 0
+
+    def call(self, fn, args):
+        """Evaluate the body of fn with its parameters bound to args."""
+        limits = fn.scope.limits
+        if not usable(limits):
+            return fn.block.eval(False, fn.scope, args)
+        if fn not in self.functions:
+            self.functions[fn] = compile_function(fn)
+        kernel = self.functions[fn]
+        if kernel is None:
+            return fn.block.eval(False, fn.scope, args)
+
+        saved = self.save(limits)
+        kernel.limits = limits
+        try:
+            for (type_, index), value in zip(kernel.params, args.values()):
+                kernel.slots[type_][index] = value
+            return kernel.run()
+        except LimitExceeded:
+            raise
+        except Exception:
+            self.restore(limits, saved)
+        return fn.block.eval(False, fn.scope, args)
+
+    def loop(self, loop, scope):
+        """Run a While or For loop in scope."""
+        limits = scope.limits
+        # Compiling reads the scope, which statistics would count
+        if not usable(limits):
+            return loop.run(False, scope)
+        if loop not in self.loops:
+            self.loops[loop] = compile_loop(loop, scope)
+        kernel = self.loops[loop]
+        if kernel is None:
+            return loop.run(False, scope)
+
+        try:
+            loaded = kernel.load(scope)
+        except OverflowError:
+            loaded = False
+        if not loaded:
+            return loop.run(False, scope)
+
+        saved = self.save(limits)
+        kernel.limits = limits
+        try:
+            value = kernel.run()
+        except LimitExceeded:
+            kernel.store(scope)
+            raise
+        except Exception:
+            # Nothing has been written back, so the loop can start over
+            self.restore(limits, saved)
+            return loop.run(False, scope)
+        kernel.store(scope)
+        return value
+
+    def __getstate__(self):
+        # Closures cannot be pickled, compiled code is rebuilt when needed
+        return {"functions": {}, "loops": {}, "fallbacks": self.fallbacks}
+
+    def save(self, limits):
+        if limits is None:
+            return None
+        return limits.steps, limits.next_check
+
+    def restore(self, limits, saved):
+        self.fallbacks += 1
+        if limits is not None:
+            limits.steps, limits.next_check = saved
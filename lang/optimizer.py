@@ -0,0 +1,456 @@
+"""Optimizer passes run on the parsed program when optimization is enabled.
+
+Passes rewrite the tree in place and keep nodes shared between several
+parents shared, as the parser's rewrites rely on it (`x * 2` becomes `x + x`
+with the same node on both sides). Each pass adds a line per change to the
+optimizer report.
+"""
+
+import copy
+from collections import Counter
+
+from lang import ast
+from lang.dump import same_shape
+
+LITERALS = (
+    ast.ValueInt,
+    ast.ValueFloat,
+    ast.ValueStr,
+    ast.ValueTrue,
+    ast.ValueFalse,
+)
+
+# Nodes without side effects, they can only fail because of operand types
+PURE = LITERALS + (
+    ast.ValueSymbol,
+    ast.Type,
+    ast.BinaryOp,
+    ast.Minus,
+    ast.Not,
+    ast.Cast,
+    ast.Args,
+    ast.Temp,
+    ast.Inline,
+    ast.FnArgs,
+    ast.FnArg,
+)
+
+# Nodes evaluated as part of the expression containing them
+EXPRESSIONS = PURE + (ast.Call,)
+
+# Expressions too cheap to be worth a temporary
+TRIVIAL = LITERALS + (ast.ValueSymbol, ast.Type, ast.Temp)
+
+# Parts of an expression which are not values on their own
+STRUCTURAL = (ast.Args, ast.FnArgs, ast.FnArg)
+
+
+def rewrite_children(node, rewrite):
+    for name in node.fields:
+        value = getattr(node, name)
+        if isinstance(value, ast.Node):
+            setattr(node, name, rewrite(value))
+        elif isinstance(value, list):
+            value[:] = [rewrite(v) for v in value]
+
+
+class Optimizer:
+    def __init__(self):
+        self.report = []
+        self.temps = 0
+
+    def optimize(self, program):
+        Inliner(self).run(program)
+        LoopInvariants(self).run(program)
+        CommonSubexpressions(self).run(program)
+        return self.report
+
+    def new_temp(self):
+        name = f"${self.temps}"
+        self.temps += 1
+        return name
+
+
+class Level:
+    """Definitions made in one frame, in statement order."""
+
+    def __init__(self):
+        self.defs = {}
+        self.index = -1
+
+    def add(self, name, index, node):
+        self.defs.setdefault(name, []).append((index, node))
+
+
+class Inliner:
+    """Replaces calls to small functions by their body.
+
+    A function is inlined when its body is a single expression using only
+    its parameters, literals, operators and builtins. The call must resolve
+    to it whenever it runs: the function is defined earlier in the same or an
+    enclosing block, nothing in between defines the same name and the name is
+    never assigned to.
+    """
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self.levels = []
+        self.done = {}
+
+    def run(self, program):
+        self.assigned = {
+            node.symbol for node in program.walk() if isinstance(node, ast.Assign)
+        }
+        program.block = self.visit(program.block)
+
+    def visit(self, node):
+        key = id(node)
+        if key in self.done:
+            return self.done[key]
+
+        if isinstance(node, ast.Block):
+            result = self.visit_block(node)
+        elif isinstance(node, ast.Fn):
+            self.visit_block(node.block, [arg.symbol for arg in node.args.args])
+            result = node
+        elif isinstance(node, ast.For):
+            level = Level()
+            for stmt in (node.begin, node.step):
+                if isinstance(stmt, (ast.Define, ast.Fn)):
+                    level.add(stmt.symbol, -1, stmt)
+            self.levels.append(level)
+            rewrite_children(node, self.visit)
+            self.levels.pop()
+            result = node
+        else:
+            rewrite_children(node, self.visit)
+            result = node
+            if isinstance(node, ast.Call):
+                result = self.inline(node) or node
+
+        self.done[key] = result
+        return result
+
+    def visit_block(self, block, params=()):
+        self.done[id(block)] = block
+        if block.block is None:
+            return block
+
+        level = Level()
+        for name in params:
+            level.add(name, -1, None)
+        for i, stmt in enumerate(block.block):
+            if isinstance(stmt, (ast.Define, ast.Fn)):
+                level.add(stmt.symbol, i, stmt)
+
+        self.levels.append(level)
+        for i, stmt in enumerate(block.block):
+            level.index = i
+            block.block[i] = self.visit(stmt)
+        self.levels.pop()
+        return block
+
+    def resolve(self, name):
+        if name in self.assigned:
+            return None
+        for level in reversed(self.levels):
+            defs = level.defs.get(name)
+            if defs:
+                if len(defs) != 1:
+                    return None
+                index, node = defs[0]
+                if isinstance(node, ast.Fn) and index < level.index:
+                    return node
+                return None
+        return None
+
+    def inline(self, call):
+        if call.symbol in ast.BUILTINS:
+            return None
+        fn = self.resolve(call.symbol)
+        if fn is None or len(call.args.args) != len(fn.args.args):
+            return None
+
+        stmts = fn.block.block
+        if not stmts or len(stmts) != 1 or not isinstance(stmts[0], ast.Statement):
+            return None
+        body = stmts[0].stmt
+        if not self.is_simple(body, {arg.symbol for arg in fn.args.args}):
+            return None
+
+        names = {}
+        params = []
+        for arg in fn.args.args:
+            names[arg.symbol] = self.optimizer.new_temp()
+            params.append(ast.FnArg(names[arg.symbol], arg.type))
+        body = self.substitute(copy.deepcopy(body), names, {})
+
+        self.optimizer.report.append(f"Inlined call to '{call.symbol}'")
+        return ast.Inline(call.symbol, ast.FnArgs(params), call.args, body)
+
+    def is_simple(self, node, params):
+        if isinstance(node, ast.ValueSymbol):
+            return node.symbol in params
+        elif isinstance(node, ast.Call):
+            simple = node.symbol in ast.BUILTINS
+        else:
+            simple = isinstance(node, PURE)
+        return simple and all(self.is_simple(c, params) for c in node.children())
+
+    def substitute(self, node, names, done):
+        key = id(node)
+        if key not in done:
+            if isinstance(node, ast.ValueSymbol) and node.symbol in names:
+                done[key] = ast.Temp(names[node.symbol])
+            else:
+                rewrite_children(node, lambda n: self.substitute(n, names, done))
+                done[key] = node
+        return done[key]
+
+
+class LoopInvariants:
+    """Moves invariant expressions out of While and For loops.
+
+    An expression is invariant when it is side effect free and reads no
+    variable defined or assigned anywhere in the loop. If the loop calls
+    user functions, which may assign variables they captured, only
+    expressions reading no variables at all are invariant. Hoisted
+    expressions are bound around the loop and computed when first used, so
+    a loop which never runs does not evaluate them.
+    """
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self.seen = set()
+        self.loops = set()
+
+    def run(self, program):
+        self.visit(program)
+
+    def visit(self, node):
+        if id(node) in self.seen:
+            return
+        self.seen.add(id(node))
+        rewrite_children(node, self.child)
+
+    def child(self, node):
+        if isinstance(node, (ast.While, ast.For)) and id(node) not in self.loops:
+            self.loops.add(id(node))
+            node = self.hoist(node)
+        self.visit(node)
+        return node
+
+    def hoist(self, loop):
+        changed = set()
+        calls = False
+        for node in loop.walk():
+            if isinstance(node, (ast.Assign, ast.Define, ast.Fn)):
+                changed.add(node.symbol)
+            elif isinstance(node, ast.Call) and node.symbol not in ast.BUILTINS:
+                calls = True
+
+        temps = []
+        done = {}
+
+        def replace(node):
+            key = id(node)
+            if key in done:
+                return done[key]
+            if isinstance(node, ast.Fn):
+                # Function bodies run in their own scope
+                result = node
+            elif self.is_invariant(node, changed, calls):
+                for name, value in temps:
+                    if same_shape(value, node):
+                        break
+                else:
+                    name = self.optimizer.new_temp()
+                    temps.append((name, node))
+                    self.optimizer.report.append(
+                        f"Hoisted '{node.label()}' out of {type(loop).__name__} loop"
+                    )
+                result = ast.Temp(name)
+            else:
+                rewrite_children(node, replace)
+                result = node
+            done[key] = result
+            return result
+
+        # The initializer of a For loop runs once anyway
+        loop.cond = replace(loop.cond)
+        loop.block = replace(loop.block)
+        if isinstance(loop, ast.For):
+            loop.step = replace(loop.step)
+
+        result = loop
+        for name, value in reversed(temps):
+            result = ast.Bind(name, value, result)
+        return result
+
+    def is_invariant(self, node, changed, calls):
+        if not isinstance(node, EXPRESSIONS) or isinstance(node, TRIVIAL + STRUCTURAL):
+            return False
+
+        bound = set()
+        used = set()
+        for n in node.walk():
+            if isinstance(n, ast.Call):
+                if n.symbol not in ast.BUILTINS:
+                    return False
+            elif not isinstance(n, PURE):
+                return False
+            elif isinstance(n, ast.ValueSymbol):
+                if calls or n.symbol in changed:
+                    return False
+            elif isinstance(n, ast.Inline):
+                bound.update(param.symbol for param in n.params.args)
+            elif isinstance(n, ast.Temp):
+                used.add(n.name)
+        # Temporaries are only valid where they are bound
+        return used <= bound
+
+
+class CommonSubexpressions:
+    """Computes repeated subexpressions once.
+
+    Within one expression, a node reached several times (shared by the
+    parser's rewrites) or several structurally equal side effect free
+    subtrees are replaced by Temp nodes bound around the expression.
+    Equal subtrees reading variables are only merged when nothing in the
+    expression could change those variables.
+    """
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self.seen = set()
+
+    def run(self, program):
+        self.visit(program)
+
+    def visit(self, node):
+        if id(node) in self.seen:
+            return
+        self.seen.add(id(node))
+
+        if isinstance(node, ast.Append):
+            # Append evaluates only the right side of its value
+            node.value.right = self.child(node.value.right)
+        else:
+            rewrite_children(node, self.child)
+
+    def child(self, node):
+        if isinstance(node, EXPRESSIONS):
+            return self.root(node)
+        self.visit(node)
+        return node
+
+    def root(self, root):
+        info = {}
+        self.analyze(root, info)
+        impure = not info[id(root)][0]
+
+        keys = {}
+        nodes = {}
+        self.assign_keys(root, info, impure, keys, nodes)
+
+        counts = Counter()
+        self.count(root, keys, counts, set())
+        candidates = {
+            key
+            for key, n in counts.items()
+            if n > 1 and not isinstance(nodes[key], TRIVIAL + STRUCTURAL)
+        }
+        while candidates:
+            counts = Counter()
+            self.count(root, keys, counts, candidates)
+            unused = {key for key in candidates if counts[key] < 2}
+            if not unused:
+                break
+            candidates -= unused
+
+        temps = {}
+        boundaries = []
+        root = self.rewrite(root, keys, candidates, temps, boundaries)
+        for key, (name, value) in temps.items():
+            self.optimizer.report.append(
+                f"Computed '{value.label()}' once for {counts[key]} uses"
+            )
+            root = ast.Bind(name, self.root(value), root)
+        for node in boundaries:
+            self.visit(node)
+        return root
+
+    def analyze(self, node, info):
+        """Record whether each node in the expression is pure and whether it
+        reads variables."""
+        if id(node) in info:
+            return info[id(node)]
+
+        if isinstance(node, EXPRESSIONS):
+            pure = not isinstance(node, ast.Call) or node.symbol in ast.BUILTINS
+            reads = isinstance(node, ast.ValueSymbol)
+            for child in node.children():
+                child_pure, child_reads = self.analyze(child, info)
+                pure = pure and child_pure
+                reads = reads or child_reads
+        else:
+            pure = False
+            reads = True
+
+        info[id(node)] = (pure, reads)
+        return pure, reads
+
+    def assign_keys(self, node, info, impure, keys, nodes):
+        """Give equal keys to nodes which may be computed once."""
+        if id(node) in keys:
+            return keys[id(node)]
+
+        pure, reads = info[id(node)]
+        if pure and not (reads and impure):
+            parts = [type(node)]
+            for name in node.fields:
+                value = getattr(node, name)
+                if isinstance(value, ast.Node):
+                    parts.append(self.assign_keys(value, info, impure, keys, nodes))
+                elif isinstance(value, list):
+                    parts.append(
+                        tuple(
+                            self.assign_keys(v, info, impure, keys, nodes)
+                            for v in value
+                        )
+                    )
+                else:
+                    parts.append(value)
+            key = tuple(parts)
+        else:
+            key = ("id", id(node))
+            if isinstance(node, EXPRESSIONS):
+                for child in node.children():
+                    self.assign_keys(child, info, impure, keys, nodes)
+
+        keys[id(node)] = key
+        nodes.setdefault(key, node)
+        return key
+
+    def count(self, node, keys, counts, opaque):
+        key = keys[id(node)]
+        counts[key] += 1
+        if key in opaque or not isinstance(node, EXPRESSIONS):
+            return
+        for child in node.children():
+            self.count(child, keys, counts, opaque)
+
+    def rewrite(self, node, keys, candidates, temps, boundaries):
+        key = keys[id(node)]
+        if key in candidates:
+            if key not in temps:
+                temps[key] = (self.optimizer.new_temp(), node)
+            return ast.Temp(temps[key][0])
+        if isinstance(node, EXPRESSIONS):
+            rewrite_children(
+                node,
+                lambda n: self.rewrite(n, keys, candidates, temps, boundaries),
+            )
+        else:
+            boundaries.append(node)
+        return node
@@ -1,17 +1,141 @@
 import operator
 
-from rply import ParserGenerator
+import rply
+from rply import ParserGenerator, Token
 
 from lang import ast
 
+# Tokens which may appear between `fn` and the opening brace of its body
+SIGNATURE = {
+    "SYMBOL",
+    "LPAREN",
+    "RPAREN",
+    "COLON",
+    "COMMA",
+    "INT",
+    "FLOAT",
+    "STR",
+    "BOOL",
+}
+
+
+class Body:
+    """Source of a function body, lexed and parsed when first needed."""
+
+    def __init__(self, parser, lexer, source):
+        self.parser = parser
+        self.lexer = lexer
+        self.source = source
+
+    def parse(self):
+        # Drop the braces, the body is parsed as a program of its own
+        source = self.source[1:-1]
+        if not source.strip():
+            return ast.Block(None)
+        tokens = self.lexer.lex(source)
+        return ast.Block(self.parser.parse(tokens, lazy=True).block.block)
+
+
+def match_brace(source, start):
+    """Return the index just past the brace closing the one at start, or
+    None if it is never closed. Braces inside strings are skipped."""
+    depth = 0
+    i = start
+    while i < len(source):
+        c = source[i]
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        elif c == '"':
+            # Strings end on the same line, like VALUE_STR
+            end = source.find('"', i + 1)
+            newline = source.find("\n", i + 1)
+            if end != -1 and (newline == -1 or end < newline):
+                i = end
+        i += 1
+    return None
+
+
+class Cursor:
+    """Source and position of an rply lexer stream.
+
+    rply offers no way to move a stream, so this reads and sets the
+    internals of its LexerStream. They are only used with the rply versions
+    they are known for, other versions parse every body eagerly.
+    """
+
+    VERSIONS = {"0.7.8"}
+    ATTRIBUTES = ("s", "idx", "_lineno", "lexer")
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.source = stream.s
+        self.lexer = stream.lexer
+
+    @classmethod
+    def of(cls, stream):
+        """Return a cursor over stream, or None if it cannot be moved."""
+        if getattr(rply, "__version__", None) not in cls.VERSIONS:
+            return None
+        if not all(hasattr(stream, name) for name in cls.ATTRIBUTES):
+            return None
+        return cls(stream)
+
+    def seek(self, end):
+        """Move the stream to the source index end."""
+        # Line numbers are only kept for error positions
+        self.stream._lineno += self.source.count("\n", self.stream.idx, end)
+        self.stream.idx = end
+
 
 class Parser:
     def __init__(self, tokens):
-        self.parser = Parser.create_parser(tokens)
+        self.parser = Parser.create_parser(tokens + ["FN_BODY"])
 
-    def parse(self, input):
+    def parse(self, input, lazy=False):
+        cursor = Cursor.of(input) if lazy else None
+        if cursor is not None:
+            input = self.skip_bodies(input, cursor)
         return self.parser.parse(input)
 
+    def skip_bodies(self, stream, cursor):
+        """Replace the body of every function with a single FN_BODY token
+        holding its source.
+
+        Bodies are found by matching braces in the source of the lexer
+        stream, which is then moved past them by cursor, so they are neither
+        lexed nor parsed here.
+        """
+        source = cursor.source
+        for token in stream:
+            yield token
+            if token.gettokentype() != "FN":
+                continue
+
+            # Pass the signature through up to the opening brace
+            for token in stream:
+                if token.gettokentype() not in SIGNATURE:
+                    break
+                yield token
+            else:
+                return
+            if token.gettokentype() != "LBRACE":
+                yield token
+                continue
+
+            start = token.getsourcepos().idx
+            end = match_brace(source, start)
+            if end is None:
+                # Unbalanced, let the parser report the error
+                yield token
+                continue
+            cursor.seek(end)
+            body = Body(self, cursor.lexer, source[start:end])
+            yield Token("FN_BODY", body, token.getsourcepos())
+
     @staticmethod
     def create_parser(tokens):
         pg = ParserGenerator(
@@ -54,6 +178,10 @@ class Parser:
         def stmt_fn(p):
             return ast.Fn(p[1].getstr(), p[3], p[5])
 
+        @pg.production("stmt : FN SYMBOL LPAREN fn_args RPAREN FN_BODY")
+        def stmt_fn_lazy(p):
+            return ast.Fn(p[1].getstr(), p[3], None, body=p[5].value)
+
         @pg.production("fn_args : fn_args COMMA def_arg")
         def fn_args(p):
             return ast.FnArgs(p[0].args + [p[2]])
@@ -76,7 +204,27 @@ class Parser:
 
         @pg.production("stmt : SYMBOL ASSIGN expr")
         def stmt_assign(p):
-            return ast.Assign(p[0].getstr(), p[2])
+            symbol = p[0].getstr()
+            value = p[2]
+
+            def can_reorder(node):
+                # The appended value is evaluated before the variable is read,
+                # so it must not be able to change the variable
+                if isinstance(node, (ast.Call, ast.Block)):
+                    return False
+                return all(can_reorder(child) for child in node.children())
+
+            # String builder optimization
+            if (
+                isinstance(value, ast.BinaryOp)
+                and value.op is operator.add
+                and isinstance(value.left, ast.ValueSymbol)
+                and value.left.symbol == symbol
+                and can_reorder(value.right)
+            ):
+                return ast.Append(symbol, value)
+
+            return ast.Assign(symbol, value)
 
         @pg.production("stmt : PRINTLN LPAREN expr RPAREN")
         @pg.production("stmt : PRINT LPAREN expr RPAREN")
@@ -191,6 +339,9 @@ class Parser:
             def is_number(x):
                 return isinstance(x, ast.ValueInt) or isinstance(x, ast.ValueFloat)
 
+            # Rewrites evaluating x twice skip operands with side effects
+            has_effects = ast.has_effects
+
             # Mathematical identities optimziation
             if op == "ADD":
                 if is_number(left) and left.value == 0:  # 0 + x = x
@@ -205,11 +356,13 @@ class Parser:
             elif op == "MUL":
                 if is_number(left) and left.value == 1:  # 1 * x = x
                     return right
-                elif is_number(left) and left.value == 2:  # 2 * x = x + x
+                elif is_number(left) and left.value == 2 and not has_effects(right):
+                    # 2 * x = x + x
                     return ast.BinaryOp(operator.add, right, right)
                 elif is_number(right) and right.value == 1:  # x * 1 = x
                     return left
-                elif is_number(right) and right.value == 2:  # x * 2 = x + x
+                elif is_number(right) and right.value == 2 and not has_effects(left):
+                    # x * 2 = x + x
                     return ast.BinaryOp(operator.add, left, left)
             elif op == "DIV":
                 if is_number(right) and right.value == 1:  # x / 1 = x
@@ -217,7 +370,8 @@ class Parser:
                 elif is_number(right) and right.value == 2:  # x / 2 = x * 0.5
                     return ast.BinaryOp(operator.mul, left, ast.ValueFloat(0.5))
             elif op == "POW":
-                if is_number(right) and right.value == 2:  # x ^ 2 = x * x
+                if is_number(right) and right.value == 2 and not has_effects(left):
+                    # x ^ 2 = x * x
                     return ast.BinaryOp(operator.mul, left, left)
 
             methods = {
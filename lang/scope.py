@@ -1,3 +1,28 @@
+class StrBuilder:
+    """String value grown by repeated appends, joined only when it is read."""
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(len(p) for p in parts)
+
+    def append(self, value):
+        self.parts.append(value)
+        self.length += len(value)
+
+    def build(self):
+        if len(self.parts) != 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0]
+
+    def __len__(self):
+        return self.length
+
+
+# Names looked up by call site caches, mapped to a number changed every time
+# a frame binds or rebinds the name
+versions = {}
+
+
 class Symbols:
     def __init__(self):
         self.symbols = {}
@@ -6,9 +31,13 @@ class Symbols:
     def add(self, name, value):
         self.symbols[name] = value
         self.used[name] = False
+        if name in versions:
+            versions[name] += 1
 
     def set(self, name, value):
         symbol = self.symbols[name]
+        if isinstance(symbol, StrBuilder):
+            symbol = symbol.build()
         if not isinstance(symbol, type(value)):
             ltype = symbol.__class__.__name__
             rtype = value.__class__.__name__
@@ -16,25 +45,54 @@ class Symbols:
                 f"Cannot assign {name} of type {rtype} to variable of type {ltype}"
             )
         self.symbols[name] = value
+        # A definition which is assigned to cannot be removed on its own
+        self.used[name] = True
+        if name in versions:
+            versions[name] += 1
 
     def get(self, name):
         self.used[name] = True
-        return self.symbols[name]
+        value = self.symbols[name]
+        if isinstance(value, StrBuilder):
+            return value.build()
+        return value
+
+    def append(self, name, value):
+        symbol = self.symbols[name]
+        if isinstance(symbol, StrBuilder):
+            symbol.append(value)
+        else:
+            symbol = self.symbols[name] = StrBuilder([symbol, value])
+        return symbol
 
     def contains(self, name):
         return name in self.symbols
 
+    def clear(self):
+        for name in self.symbols:
+            if name in versions:
+                versions[name] += 1
+        self.symbols.clear()
+        self.used.clear()
+
 
 class Scope:
-    def __init__(self):
+    def __init__(self, limits=None, memo=None, numeric=None):
         self.symbols_stack = []
         self.last_pop = None
+        self.limits = limits
+        self.memo = memo
+        self.numeric = numeric
+        # Values of optimizer temporaries, a stack per name
+        self.temps = {}
 
     def add(self, name, value):
         if self.symbols_stack[0].contains(name):
             raise ValueError(f"Identifier '{name}' is already defined")
         else:
             self.symbols_stack[0].add(name, value)
+        if self.memo is not None:
+            self.memo.rebind(name)
 
     def set(self, name, value):
         found = False
@@ -45,6 +103,8 @@ class Scope:
                 break
         if not found:
             raise ValueError(f"Undefined identifier '{name}'")
+        if self.memo is not None:
+            self.memo.rebind(name)
 
     def get(self, name):
         for symbols in self.symbols_stack:
@@ -52,8 +112,18 @@ class Scope:
                 return symbols.get(name)
         raise ValueError(f"Undefined identifier '{name}'")
 
-    def push(self):
-        self.symbols_stack.insert(0, Symbols())
+    def find(self, name):
+        for symbols in self.symbols_stack:
+            if symbols.contains(name):
+                return symbols
+        raise ValueError(f"Undefined identifier '{name}'")
+
+    def push(self, symbols=None):
+        if symbols is None:
+            symbols = Symbols()
+        self.symbols_stack.insert(0, symbols)
+        if self.limits is not None:
+            self.limits.check_depth(len(self.symbols_stack))
 
     def pop(self):
         self.last_pop = self.symbols_stack.pop(0)
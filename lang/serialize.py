@@ -0,0 +1,330 @@
+"""Compact binary serialization of the AST.
+
+Layout (all integers little-endian):
+
+    header      magic, version, the sizes of the sections below and the
+                CRC-32 of everything after the header
+    node index  u32 word offset of every node record
+    const index u32 byte offset of every constant
+    nodes       per node: u32 kind followed by one u32 reference per field
+    lists       per list: u32 length followed by u32 references
+    consts      per constant: u8 tag followed by its payload
+
+A reference packs a 2-bit tag (node, constant, list or None) with an index.
+Nodes shared between several parents are stored once, so the loaded tree
+keeps the same sharing. Loading is lazy: the body of a function is left in
+the buffer until the function is first called, or its block read otherwise,
+so only the top level of a program is built when it is loaded. The buffer,
+a memory map of the file for load(), stays open until every body is built.
+Corrupted data is reported as a ValueError, which for a function body is
+raised when the body is built.
+"""
+
+import mmap
+import operator
+import struct
+import zlib
+
+from lang import ast
+
+MAGIC = b"KUTA"
+VERSION = 2
+
+HEADER = struct.Struct("<4sHHIIIIIII")
+PREFIX = struct.Struct("<4sH")
+
+# Never reorder, the position of a class is its kind in the file
+KINDS = (
+    ast.Program,
+    ast.Block,
+    ast.Statement,
+    ast.Fn,
+    ast.FnArg,
+    ast.FnArgs,
+    ast.Define,
+    ast.Assign,
+    ast.Print,
+    ast.ValueInt,
+    ast.ValueFloat,
+    ast.ValueStr,
+    ast.ValueTrue,
+    ast.ValueFalse,
+    ast.ValueSymbol,
+    ast.Type,
+    ast.BinaryOp,
+    ast.If,
+    ast.IfElse,
+    ast.While,
+    ast.For,
+    ast.Minus,
+    ast.Not,
+    ast.Cast,
+    ast.Args,
+    ast.Call,
+    ast.Append,
+    ast.Inline,
+    ast.Bind,
+    ast.Temp,
+)
+
+REF_NODE = 0
+REF_CONST = 1
+REF_LIST = 2
+REF_NONE = 3
+
+TYPES = {"int": int, "float": float, "str": str, "bool": bool}
+
+I64 = struct.Struct("<q")
+F64 = struct.Struct("<d")
+U32 = struct.Struct("<I")
+
+# Errors malformed data causes while it is read
+CORRUPTED = (IndexError, KeyError, AttributeError, struct.error, ValueError)
+
+
+class Writer:
+    def __init__(self):
+        self.node_index = {}
+        self.node_offsets = []
+        self.nodes = []
+        self.lists = []
+        self.const_index = {}
+        self.const_offsets = []
+        self.consts = bytearray()
+        self.kinds = {cls: i for i, cls in enumerate(KINDS)}
+
+    def write(self, root):
+        root = self.add_node(root)
+        words = self.node_offsets + self.const_offsets + self.nodes + self.lists
+        data = struct.pack(f"<{len(words)}I", *words) + bytes(self.consts)
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            0,
+            len(self.node_offsets),
+            len(self.nodes),
+            len(self.lists),
+            len(self.const_offsets),
+            len(self.consts),
+            root,
+            zlib.crc32(data),
+        )
+        return header + data
+
+    def add_node(self, node):
+        key = id(node)
+        if key in self.node_index:
+            return self.node_index[key]
+
+        cls = type(node)
+        if cls not in self.kinds:
+            raise ValueError(f"Cannot serialize node of type {cls.__name__}")
+        refs = [self.ref(getattr(node, name)) for name in cls.fields]
+
+        index = len(self.node_offsets)
+        self.node_index[key] = index
+        self.node_offsets.append(len(self.nodes))
+        self.nodes.append(self.kinds[cls])
+        self.nodes.extend(refs)
+        return index
+
+    def ref(self, value):
+        if value is None:
+            return REF_NONE
+        elif isinstance(value, ast.Node):
+            return self.add_node(value) << 2 | REF_NODE
+        elif isinstance(value, list):
+            refs = [self.ref(v) for v in value]
+            offset = len(self.lists)
+            self.lists.append(len(refs))
+            self.lists.extend(refs)
+            return offset << 2 | REF_LIST
+        else:
+            return self.add_const(value) << 2 | REF_CONST
+
+    def add_const(self, value):
+        key = (type(value), value)
+        if key in self.const_index:
+            return self.const_index[key]
+
+        if isinstance(value, bool):
+            data = b"b" + bytes([value])
+        elif isinstance(value, int):
+            if -(2**63) <= value < 2**63:
+                data = b"i" + I64.pack(value)
+            else:
+                data = b"n" + self.pack_str(str(value))
+        elif isinstance(value, float):
+            data = b"f" + F64.pack(value)
+        elif isinstance(value, str):
+            data = b"s" + self.pack_str(value)
+        elif isinstance(value, type) and value.__name__ in TYPES:
+            data = b"t" + self.pack_str(value.__name__)
+        elif getattr(operator, getattr(value, "__name__", ""), None) is value:
+            data = b"o" + self.pack_str(value.__name__)
+        else:
+            raise ValueError(f"Cannot serialize value {value!r}")
+
+        index = len(self.const_offsets)
+        self.const_index[key] = index
+        self.const_offsets.append(len(self.consts))
+        self.consts += data
+        return index
+
+    @staticmethod
+    def pack_str(value):
+        data = value.encode("utf-8")
+        return U32.pack(len(data)) + data
+
+
+class Reader:
+    def __init__(self, buffer):
+        # Magic and version come first in every version of the format
+        if len(buffer) < PREFIX.size:
+            raise ValueError("Truncated AST data")
+        magic, version = PREFIX.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a serialized AST")
+        if version != VERSION:
+            raise ValueError(f"Unsupported AST format version {version}")
+        if len(buffer) < HEADER.size:
+            raise ValueError("Truncated AST data")
+        (
+            _,
+            _,
+            _,
+            node_count,
+            node_words,
+            list_words,
+            const_count,
+            const_bytes,
+            self.root_index,
+            checksum,
+        ) = HEADER.unpack_from(buffer, 0)
+
+        self.buffer = buffer
+        self.node_count = node_count
+        self.node_offsets = HEADER.size
+        self.const_offsets = self.node_offsets + 4 * node_count
+        self.nodes_start = self.const_offsets + 4 * const_count
+        self.lists_start = self.nodes_start + 4 * node_words
+        self.consts_start = self.lists_start + 4 * list_words
+        end = self.consts_start + const_bytes
+        if len(buffer) < end:
+            raise ValueError("Truncated AST data")
+        with memoryview(buffer) as view, view[HEADER.size : end] as data:
+            if zlib.crc32(data) != checksum:
+                raise ValueError("Corrupted AST data")
+
+        self.nodes = {}
+        self.consts = {}
+
+    def root(self):
+        return self.build(self.root_index << 2 | REF_NODE)
+
+    def build(self, ref):
+        try:
+            return self.value(ref)
+        except CORRUPTED as err:
+            raise ValueError("Corrupted AST data") from err
+
+    def node(self, index):
+        if index in self.nodes:
+            return self.nodes[index]
+
+        (offset,) = U32.unpack_from(self.buffer, self.node_offsets + 4 * index)
+        offset = self.nodes_start + 4 * offset
+        (kind,) = U32.unpack_from(self.buffer, offset)
+        cls = KINDS[kind]
+        refs = struct.unpack_from(f"<{len(cls.fields)}I", self.buffer, offset + 4)
+
+        node = cls.__new__(cls)
+        for name, ref in zip(cls.fields, refs):
+            if cls is ast.Fn and name == "block":
+                # Built by the LazyBlock descriptor of Fn on first use
+                node.body = Body(self, ref)
+            else:
+                setattr(node, name, self.value(ref))
+
+        self.nodes[index] = node
+        return node
+
+    def value(self, ref):
+        tag = ref & 3
+        index = ref >> 2
+        if tag == REF_NODE:
+            return self.node(index)
+        elif tag == REF_CONST:
+            return self.const(index)
+        elif tag == REF_LIST:
+            offset = self.lists_start + 4 * index
+            (count,) = U32.unpack_from(self.buffer, offset)
+            refs = struct.unpack_from(f"<{count}I", self.buffer, offset + 4)
+            return [self.value(r) for r in refs]
+        else:
+            return None
+
+    def const(self, index):
+        if index in self.consts:
+            return self.consts[index]
+
+        (offset,) = U32.unpack_from(self.buffer, self.const_offsets + 4 * index)
+        offset = self.consts_start + offset
+        tag = self.buffer[offset : offset + 1]
+        offset += 1
+        if tag == b"b":
+            value = self.buffer[offset] != 0
+        elif tag == b"i":
+            (value,) = I64.unpack_from(self.buffer, offset)
+        elif tag == b"f":
+            (value,) = F64.unpack_from(self.buffer, offset)
+        else:
+            (length,) = U32.unpack_from(self.buffer, offset)
+            value = bytes(self.buffer[offset + 4 : offset + 4 + length]).decode()
+            if tag == b"n":
+                value = int(value)
+            elif tag == b"t":
+                value = TYPES[value]
+            elif tag == b"o":
+                value = getattr(operator, value)
+            elif tag != b"s":
+                raise ValueError("Corrupted AST constant pool")
+
+        self.consts[index] = value
+        return value
+
+
+class Body:
+    """Function body still in the buffer of a Reader."""
+
+    def __init__(self, reader, ref):
+        self.reader = reader
+        self.ref = ref
+
+    def parse(self):
+        return self.reader.build(self.ref)
+
+
+def dumps(node):
+    return Writer().write(node)
+
+
+def loads(data):
+    return Reader(data).root()
+
+
+def dump(node, path):
+    with open(path, "wb") as f:
+        f.write(dumps(node))
+
+
+def is_serialized(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load(path):
+    with open(path, "rb") as f:
+        # The map stays valid after the file is closed
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Reader(buffer).root()
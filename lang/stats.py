@@ -0,0 +1,209 @@
+"""Execution counters and event hooks.
+
+While a Stats object is active, the eval methods of the AST classes, the
+Scope lookup and frame methods and the print used by the interpreter are
+replaced with counting versions. They are restored when it stops, so a run
+without statistics executes the unmodified interpreter. Only one Stats
+object can be active at a time.
+"""
+
+import builtins
+import json
+import time
+
+from lang import ast
+from lang.scope import Scope
+
+EVENTS = ("call_enter", "call_exit", "loop_iteration", "error")
+
+# The Stats object currently patched in, if any
+active = None
+
+
+class Stats:
+    def __init__(self):
+        self.nodes = 0
+        self.calls = 0
+        self.pushes = 0
+        self.pops = 0
+        self.lookups = 0
+        self.lookup_depth = 0
+        self.iterations = 0
+        self.bytes_printed = 0
+        self.errors = 0
+        self.time = 0.0
+        self.hooks = {event: [] for event in EVENTS}
+        # Bodies of the loops seen so far, mapped to their loop
+        self.loops = {}
+        self.saved = []
+
+    def on(self, event, hook):
+        """Call hook with the event arguments every time event happens:
+        call_enter(name), call_exit(name, value), loop_iteration(loop) and
+        error(exception)."""
+        if event not in self.hooks:
+            raise ValueError(f"Unknown event '{event}'")
+        self.hooks[event].append(hook)
+
+    def emit(self, event, *args):
+        for hook in self.hooks[event]:
+            hook(*args)
+
+    def start(self):
+        global active
+        if active is not None:
+            raise RuntimeError("Another Stats object is already active")
+        active = self
+        self.started = time.perf_counter()
+
+        for cls in vars(ast).values():
+            if (
+                isinstance(cls, type)
+                and issubclass(cls, ast.Node)
+                and "eval" in vars(cls)
+            ):
+                self.patch(cls, "eval", self.wrap_eval(cls))
+        self.patch(ast.Call, "eval", self.wrap_call(ast.Call.eval))
+        self.patch(ast.Block, "eval", self.wrap_block(ast.Block.eval))
+        self.patch(ast.While, "eval", self.wrap_loop(ast.While.eval))
+        self.patch(ast.For, "eval", self.wrap_loop(ast.For.eval))
+        self.patch(Scope, "get", self.wrap_get())
+        self.patch(Scope, "find", self.wrap_find())
+        self.patch(Scope, "push", self.wrap_push(Scope.push))
+        self.patch(Scope, "pop", self.wrap_pop(Scope.pop))
+        ast.print = self.print
+
+    def stop(self):
+        global active
+        for owner, name, value in reversed(self.saved):
+            setattr(owner, name, value)
+        self.saved = []
+        del ast.print
+        self.time += time.perf_counter() - self.started
+        active = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and isinstance(exc, Exception):
+            self.error(exc)
+        self.stop()
+
+    def error(self, err):
+        self.errors += 1
+        self.emit("error", err)
+
+    def patch(self, owner, name, value):
+        self.saved.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, value)
+
+    def wrap_eval(self, cls):
+        original = cls.eval
+
+        def eval(node, *args, **kwargs):
+            # Subclasses calling super().eval are counted once
+            if type(node) is cls:
+                self.nodes += 1
+            return original(node, *args, **kwargs)
+
+        return eval
+
+    def wrap_call(self, original):
+        hooks = self.hooks
+
+        def eval(node, opt, scope):
+            self.calls += 1
+            if hooks["call_enter"]:
+                self.emit("call_enter", node.symbol)
+            value = original(node, opt, scope)
+            if hooks["call_exit"]:
+                self.emit("call_exit", node.symbol, value)
+            return value
+
+        return eval
+
+    def wrap_block(self, original):
+        loops = self.loops
+
+        def eval(node, opt, scope, *args, **kwargs):
+            if not opt and id(node) in loops:
+                self.iterations += 1
+                if self.hooks["loop_iteration"]:
+                    self.emit("loop_iteration", loops[id(node)])
+            return original(node, opt, scope, *args, **kwargs)
+
+        return eval
+
+    def wrap_loop(self, original):
+        loops = self.loops
+
+        def eval(node, opt, scope):
+            # A loop body is only ever evaluated by its loop
+            loops[id(node.block)] = node
+            return original(node, opt, scope)
+
+        return eval
+
+    def search(self, scope, name):
+        self.lookups += 1
+        for depth, symbols in enumerate(scope.symbols_stack, 1):
+            if symbols.contains(name):
+                self.lookup_depth += depth
+                return symbols
+        self.lookup_depth += len(scope.symbols_stack)
+        raise ValueError(f"Undefined identifier '{name}'")
+
+    def wrap_get(self):
+        def get(scope, name):
+            return self.search(scope, name).get(name)
+
+        return get
+
+    def wrap_find(self):
+        def find(scope, name):
+            return self.search(scope, name)
+
+        return find
+
+    def wrap_push(self, original):
+        def push(scope, symbols=None):
+            self.pushes += 1
+            original(scope, symbols)
+
+        return push
+
+    def wrap_pop(self, original):
+        def pop(scope):
+            self.pops += 1
+            original(scope)
+
+        return pop
+
+    def print(self, *values, sep=" ", end="\n", **kwargs):
+        text = sep.join(str(v) for v in values) + end
+        self.bytes_printed += len(text.encode("utf-8"))
+        builtins.print(text, end="", **kwargs)
+
+    def to_dict(self):
+        elapsed = self.time
+        if active is self:
+            elapsed += time.perf_counter() - self.started
+        return {
+            "nodes": self.nodes,
+            "calls": self.calls,
+            "scope_pushes": self.pushes,
+            "scope_pops": self.pops,
+            "lookups": self.lookups,
+            "average_lookup_depth": (
+                round(self.lookup_depth / self.lookups, 3) if self.lookups else 0
+            ),
+            "loop_iterations": self.iterations,
+            "bytes_printed": self.bytes_printed,
+            "errors": self.errors,
+            "time": round(elapsed, 6),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
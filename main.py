@@ -1,42 +1,84 @@
 import argparse
+import contextlib
 import sys
 import copy
+import pickle
+import re
+import time
 
-from graphviz import Digraph
 from rply import LexingError, ParsingError
 
+from lang import check, dump, serialize
+from lang.ast import Fn, Program
 from lang.lexer import Lexer
+from lang.limits import Limits, LimitExceeded
+from lang.memo import Memo
+from lang.numeric import Numeric
+from lang.optimizer import Optimizer
 from lang.parser import Parser
-from lang.scope import Scope
+from lang.scope import Scope, Symbols
+from lang.stats import Stats
 
 lexer = Lexer()
 parser = Parser(lexer.tokens)
 
 
-def execute(scope, source, draw=False, lexer_output=False, opt=False):
+def execute(
+    scope,
+    source,
+    draw=False,
+    lexer_output=False,
+    opt=False,
+    limits=None,
+    persistent=False,
+    memo=None,
+    explain_opt=False,
+    stats=None,
+    lazy=False,
+    numeric=None,
+):
+    # LimitExceeded is deliberately not handled here so callers can catch it
+    if limits is not None:
+        limits.start()
+        scope.limits = limits
+    if memo is not None:
+        scope.memo = memo
+    if numeric is not None:
+        scope.numeric = numeric
+
     try:
-        tokens = lexer.lex(source)
+        if isinstance(source, Program):
+            ast = source
+        else:
+            tokens = lexer.lex(source)
 
-        if lexer_output:
-            print("LEXER OUTPUT")
-            for token in copy.copy(tokens):
-                print(token)
-            print()
-            print("PROGRAM OUTPUT")
+            if lexer_output:
+                print("LEXER OUTPUT")
+                for token in copy.copy(tokens):
+                    print(token)
+                print()
+                print("PROGRAM OUTPUT")
 
-        ast = parser.parse(tokens)
+            ast = parser.parse(tokens, lazy=lazy)
 
         # Optimize
         if opt:
             ast.eval(True, scope)
+            report = Optimizer().optimize(ast)
+            if explain_opt:
+                for line in report:
+                    print(line, file=sys.stderr)
 
-        result = ast.eval(False, scope)
+        with stats or contextlib.nullcontext():
+            if persistent:
+                # Evaluate in the innermost frame so that definitions outlive the call
+                result = ast.block.eval_stmts(False, scope)
+            else:
+                result = ast.eval(False, scope)
 
         # Draw AST graph
         if draw:
-            g = Digraph()
-            ast.draw(g)
-            g.render("ast", format="png", view=True, cleanup=True)
+            dump.render(ast)
 
         return result
     except ValueError as err:
@@ -47,25 +89,207 @@ def execute(scope, source, draw=False, lexer_output=False, opt=False):
         print("Parsing error")
 
 
-def run_repl():
-    scope = Scope()
+class Session:
+    """Interactive session keeping a persistent global environment."""
+
+    def __init__(self, limits=None, memo=None, stats=None, numeric=None):
+        self.scope = Scope(limits, memo, numeric)
+        self.scope.push()
+        self.stats = stats
+        self.last_time = None
+
+    def run(self, source):
+        depth = len(self.scope.symbols_stack)
+        started = time.perf_counter()
+        try:
+            return execute(
+                self.scope,
+                source,
+                limits=self.scope.limits,
+                persistent=True,
+                stats=self.stats,
+            )
+        finally:
+            self.last_time = time.perf_counter() - started
+            # Drop frames left behind by an interrupted evaluation
+            del self.scope.symbols_stack[:-depth]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.scope.symbols_stack[-1], f)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            symbols = pickle.load(f)
+        if not isinstance(symbols, Symbols):
+            raise ValueError("not a session snapshot")
+        for value in symbols.symbols.values():
+            if isinstance(value, Fn):
+                value.scope.limits = self.scope.limits
+                value.scope.memo = self.scope.memo
+                value.scope.numeric = self.scope.numeric
+        self.scope.symbols_stack[-1] = symbols
+
+
+def is_incomplete(source):
+    source = re.sub(r'"(.*?)"', "", source)
+    return source.count("{") > source.count("}") or source.count(
+        "("
+    ) > source.count(")")
+
+
+# Errors unpickling a missing, truncated or foreign file may raise
+LOAD_ERRORS = (
+    OSError,
+    EOFError,
+    pickle.UnpicklingError,
+    AttributeError,
+    ImportError,
+    IndexError,
+    TypeError,
+    ValueError,
+)
+
+
+def run_command(session, command):
+    name, _, arg = command.partition(" ")
+    arg = arg.strip()
+    if name == ":time":
+        if session.last_time is None:
+            print("Nothing has been run yet")
+        else:
+            print(f"{session.last_time * 1000:.3f} ms")
+    elif name == ":save" and arg:
+        try:
+            session.save(arg)
+        except (OSError, pickle.PicklingError, TypeError) as err:
+            print(f"Cannot save session: {err}")
+    elif name == ":load" and arg:
+        try:
+            session.load(arg)
+        except LOAD_ERRORS as err:
+            print(f"Cannot load session: {err or type(err).__name__}")
+    elif name == ":quit":
+        return False
+    else:
+        print("Commands: :time, :save <path>, :load <path>, :quit")
+    return True
+
+
+def run_repl(limits=None, memo=None, stats=None, numeric=None):
+    session = Session(limits, memo, stats, numeric)
     while True:
         try:
             source = input("> ")
-            result = execute(scope, source)
+            while is_incomplete(source):
+                source += "\n" + input(". ")
+
+            if source.startswith(":"):
+                if not run_command(session, source.strip()):
+                    break
+                continue
+
+            try:
+                result = session.run(source)
+            except LimitExceeded as err:
+                print(err)
+                result = None
             if result is not None:
                 print(result)
-            if scope.last_pop is not None:
-                scope.symbols_stack.insert(0, scope.last_pop)
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             break
 
 
-def run_file(path, draw=False, lexer_output=False):
+def run_file(
+    path,
+    draw=False,
+    lexer_output=False,
+    limits=None,
+    memo=None,
+    opt=False,
+    explain_opt=False,
+    stats=None,
+    lazy=False,
+    numeric=None,
+):
     scope = Scope()
+    if serialize.is_serialized(path):
+        try:
+            source = serialize.load(path)
+        except ValueError as err:
+            print(f"Cannot load {path}: {err}")
+            sys.exit(1)
+    else:
+        with open(path, "r") as f:
+            source = f.read()
+    try:
+        execute(
+            scope,
+            source,
+            draw=draw,
+            lexer_output=lexer_output,
+            limits=limits,
+            memo=memo,
+            opt=opt,
+            explain_opt=explain_opt,
+            stats=stats,
+            lazy=lazy,
+            numeric=numeric,
+        )
+    except LimitExceeded as err:
+        print(err)
+        sys.exit(1)
+
+
+def dump_file(path, format, output=None, **options):
     with open(path, "r") as f:
         source = f.read()
-        execute(scope, source, draw=draw, lexer_output=lexer_output)
+    try:
+        ast = parser.parse(lexer.lex(source))
+    except LexingError:
+        print("Lexing error")
+        return
+    except ParsingError:
+        print("Parsing error")
+        return
+
+    if output is None:
+        dump.dump(ast, sys.stdout, format, **options)
+    else:
+        with open(output, "w", encoding="utf-8") as f:
+            dump.dump(ast, f, format, **options)
+
+
+def check_source(source):
+    """Return the messages --check prints for source."""
+    try:
+        return check.check(parser.parse(lexer.lex(source)))
+    except LexingError as err:
+        return [f"Lexing error at line {err.getsourcepos().lineno}"]
+    except ParsingError as err:
+        pos = err.getsourcepos()
+        return ["Parsing error" + (f" at line {pos.lineno}" if pos else "")]
+
+
+def check_file(path):
+    with open(path, "r") as f:
+        source = f.read()
+    errors = check_source(source)
+    for error in errors:
+        print(error)
+    if errors:
+        sys.exit(1)
+
+
+def compile_file(path, output):
+    with open(path, "r") as f:
+        source = f.read()
+    try:
+        serialize.dump(parser.parse(lexer.lex(source)), output)
+    except LexingError:
+        print("Lexing error")
+    except ParsingError:
+        print("Parsing error")
 
 
 if __name__ == "__main__":
@@ -77,9 +301,150 @@ if __name__ == "__main__":
     arg_parser.add_argument(
         "-l", "--lexer", help="print lexer output", action="store_true"
     )
+    arg_parser.add_argument(
+        "--max-steps", help="maximum number of executed steps", type=int
+    )
+    arg_parser.add_argument(
+        "--max-time", help="maximum execution time in seconds", type=float
+    )
+    arg_parser.add_argument(
+        "--max-str-len", help="maximum length of a string value", type=int
+    )
+    arg_parser.add_argument("--max-depth", help="maximum scope depth", type=int)
+    arg_parser.add_argument(
+        "-O", "--optimize", help="optimize the script", action="store_true"
+    )
+    arg_parser.add_argument(
+        "--explain-opt",
+        help="optimize the script and print what the optimizer changed",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-m",
+        "--memo",
+        metavar="SIZE",
+        help="cache results of pure functions, SIZE entries per function",
+        type=int,
+        nargs="?",
+        const=128,
+    )
+    arg_parser.add_argument(
+        "--memo-stats",
+        help="print function cache statistics after running",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--stats",
+        metavar="PATH",
+        help="write execution counters as JSON to PATH, or stderr if omitted",
+        nargs="?",
+        const="-",
+    )
+    arg_parser.add_argument(
+        "--lazy",
+        help="parse function bodies when they are first called",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--numeric",
+        help="run functions and loops using only ints and floats on typed storage",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--check",
+        help="check the whole script for errors without running it",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-c",
+        "--compile",
+        metavar="OUTPUT",
+        help="save the parsed script to OUTPUT instead of running it",
+    )
+    arg_parser.add_argument(
+        "-d",
+        "--dump",
+        choices=sorted(dump.WRITERS),
+        help="print abstract syntax tree in the given format instead of running",
+    )
+    arg_parser.add_argument("--dump-output", help="write the dump to a file")
+    arg_parser.add_argument("--dump-depth", help="maximum dumped depth", type=int)
+    arg_parser.add_argument(
+        "--dump-children", help="maximum dumped statements per block", type=int
+    )
+    arg_parser.add_argument("--dump-nodes", help="maximum dumped nodes", type=int)
+    arg_parser.add_argument(
+        "--no-collapse",
+        help="do not merge repeated sibling statements in the dump",
+        action="store_true",
+    )
     args = arg_parser.parse_args()
 
-    if args.file:
-        run_file(args.file, draw=args.ast, lexer_output=args.lexer)
+    limits = None
+    if any(
+        x is not None
+        for x in (args.max_steps, args.max_time, args.max_str_len, args.max_depth)
+    ):
+        limits = Limits(
+            max_steps=args.max_steps,
+            max_time=args.max_time,
+            max_str_len=args.max_str_len,
+            max_depth=args.max_depth,
+        )
+
+    memo = None
+    if args.memo is not None:
+        if args.memo < 0:
+            arg_parser.error("--memo SIZE cannot be negative")
+        memo = Memo(args.memo)
+    elif args.memo_stats:
+        arg_parser.error("--memo-stats requires --memo")
+
+    stats = None
+    if args.stats is not None:
+        stats = Stats()
+
+    numeric = Numeric() if args.numeric else None
+
+    if args.file and args.dump:
+        dump_file(
+            args.file,
+            args.dump,
+            args.dump_output,
+            max_depth=args.dump_depth,
+            max_children=args.dump_children,
+            max_nodes=args.dump_nodes,
+            collapse=not args.no_collapse,
+        )
+    elif args.file and args.check:
+        check_file(args.file)
+    elif args.file and args.compile:
+        compile_file(args.file, args.compile)
+    elif args.file:
+        run_file(
+            args.file,
+            draw=args.ast,
+            lexer_output=args.lexer,
+            limits=limits,
+            memo=memo,
+            opt=args.optimize or args.explain_opt,
+            explain_opt=args.explain_opt,
+            stats=stats,
+            lazy=args.lazy,
+            numeric=numeric,
+        )
     else:
-        run_repl()
+        run_repl(limits=limits, memo=memo, stats=stats, numeric=numeric)
+
+    if args.memo_stats:
+        for name, entry in memo.stats().items():
+            print(
+                f"{name}: {entry['hits']} hits, {entry['misses']} misses",
+                file=sys.stderr,
+            )
+
+    if args.stats == "-":
+        print(stats.to_json(indent=2), file=sys.stderr)
+    elif args.stats is not None:
+        with open(args.stats, "w") as f:
+            f.write(stats.to_json(indent=2) + "\n")
@@ -0,0 +1,385 @@
+"""Concurrent execution of scripts by a pool of warm worker processes.
+
+Each worker is a Python process which has imported the interpreter, so its
+lexer and parser are built once, and which runs one job at a time. Jobs and
+results are exchanged over the worker's stdin and stdout as JSON messages,
+each preceded by its length as 4 bytes. Parsed programs are kept in an LRU
+cache in every worker, keyed by the hash of their source, so running a
+registered program again skips lexing and parsing.
+
+A job is limited to its timeout by the interpreter's own time limit. A
+worker still busy shortly after that, for example inside a single huge
+arithmetic operation, is killed and replaced. A worker whose job is
+cancelled only takes another one once it has sent the cancelled job's
+result, which is then dropped.
+
+    async with Service(workers=4) as service:
+        fib = service.register(source)
+        result = await service.run(program=fib, inputs={"n": 20})
+        print(result["stdout"], result["result"])
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import time
+
+from rply import LexingError, ParsingError
+
+from main import lexer, parser
+from lang.ast import Fn
+from lang.limits import Limits, LimitExceeded
+from lang.memo import LRUCache
+from lang.numeric import Numeric
+from lang.scope import Scope
+
+HEADER = struct.Struct(">I")
+
+# Time a worker gets after the timeout of a job to stop on its own
+GRACE = 1.0
+
+INPUT_TYPES = (int, float, str, bool)
+
+
+def program_id(source):
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def encode(message):
+    data = json.dumps(message).encode("utf-8")
+    return HEADER.pack(len(data)) + data
+
+
+def read_message(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack(header)
+    return json.loads(stream.read(size))
+
+
+def write_message(stream, message):
+    stream.write(encode(message))
+    stream.flush()
+
+
+def value(result):
+    if isinstance(result, Fn):
+        return f"<fn {result.symbol}>"
+    if result is None or isinstance(result, INPUT_TYPES):
+        return result
+    return repr(result)
+
+
+class Worker:
+    """Runs jobs inside a worker process."""
+
+    def __init__(self, cache_size=64, numeric=False, limits=None):
+        self.programs = LRUCache(cache_size)
+        self.numeric = numeric
+        # Keyword arguments of Limits applied to every job
+        self.limits = limits or {}
+
+    def program(self, job):
+        """Return the cached program of job, its numeric tier and its
+        functions, parsing the source sent with the job if the program is
+        not cached."""
+        entry = self.programs.get(job["program"])
+        if entry is None and job.get("source") is not None:
+            program = parser.parse(lexer.lex(job["source"]))
+            functions = [node for node in program.walk() if isinstance(node, Fn)]
+            entry = (program, Numeric() if self.numeric else None, functions)
+            self.programs.put(job["program"], entry)
+        return entry
+
+    def run(self, job):
+        started = time.perf_counter()
+        response = self.execute(job)
+        response["time"] = round(time.perf_counter() - started, 6)
+        return response
+
+    def execute(self, job):
+        response = {"stdout": "", "result": None, "error": None}
+        try:
+            entry = self.program(job)
+        except LexingError:
+            response["error"] = "Lexing error"
+            return response
+        except ParsingError:
+            response["error"] = "Parsing error"
+            return response
+        if entry is None:
+            response["error"] = "Unknown program"
+            response["missing"] = True
+            return response
+        program, numeric, functions = entry
+
+        limits = Limits(max_time=job.get("timeout"), **self.limits)
+        scope = Scope(limits, numeric=numeric)
+        scope.push()
+        output = io.StringIO()
+        try:
+            for name, input in (job.get("inputs") or {}).items():
+                if not isinstance(input, INPUT_TYPES):
+                    raise ValueError(f"Unsupported type of input '{name}'")
+                scope.add(name, input)
+            with contextlib.redirect_stdout(output):
+                # Inputs and definitions share the global frame
+                response["result"] = value(program.block.eval_stmts(False, scope))
+        except (ValueError, LimitExceeded) as err:
+            response["error"] = str(err)
+        except Exception as err:
+            response["error"] = f"{type(err).__name__}: {err}"
+        finally:
+            # Defined functions refer to the frames of this job, which the
+            # cached program must not keep alive until its next run
+            for fn in functions:
+                fn.scope = None
+        response["stdout"] = output.getvalue()
+        return response
+
+    def serve(self, stdin, stdout):
+        write_message(stdout, {"ready": True})
+        while True:
+            job = read_message(stdin)
+            if job is None:
+                break
+            write_message(stdout, self.run(job))
+
+
+class Process:
+    """Worker process as seen from the service."""
+
+    def __init__(self, process):
+        self.process = process
+        # Programs whose source this worker has been sent
+        self.known = set()
+        # Reads the response to the last request
+        self.pending = None
+
+    async def request(self, job):
+        self.process.stdin.write(encode(job))
+        # The response is read by a task of its own, so a request which is
+        # cancelled cannot leave half a message in the pipe
+        self.pending = asyncio.ensure_future(self.receive())
+        await self.process.stdin.drain()
+        return await asyncio.shield(self.pending)
+
+    async def receive(self):
+        stdout = self.process.stdout
+        (size,) = HEADER.unpack(await stdout.readexactly(HEADER.size))
+        return json.loads(await stdout.readexactly(size))
+
+    async def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+        await self.process.wait()
+        if self.pending is not None:
+            # Fails now that the pipe is closed
+            await asyncio.gather(self.pending, return_exceptions=True)
+
+
+class Service:
+    """Pool of worker processes running scripts for asyncio code.
+
+    Jobs name a program registered with register() or carry their source,
+    which is not kept, and may pass inputs, which are defined as global
+    variables before the script runs. run() returns a dict with the printed
+    output, the value of the last statement, an error message or None and
+    the time the worker took.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        cache_size=64,
+        timeout=5.0,
+        numeric=False,
+        max_steps=None,
+        max_str_len=None,
+        max_depth=None,
+    ):
+        self.size = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.options = {
+            "cache_size": cache_size,
+            "numeric": numeric,
+            "limits": {
+                "max_steps": max_steps,
+                "max_str_len": max_str_len,
+                "max_depth": max_depth,
+            },
+        }
+        # Registered programs, sources passed to run() are not kept
+        self.sources = {}
+        self.idle = collections.deque()
+        # Jobs waiting for a worker, served in order of arrival
+        self.waiting = collections.deque()
+        self.workers = []
+        # Tasks replacing workers or waiting for results of cancelled jobs
+        self.recovering = set()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        workers = await asyncio.gather(*(self.spawn() for _ in range(self.size)))
+        for worker in workers:
+            self.release(worker)
+
+    async def close(self):
+        for task in self.recovering:
+            task.cancel()
+        await asyncio.gather(*self.recovering, return_exceptions=True)
+        for worker in self.workers:
+            worker.process.stdin.close()
+        for worker in self.workers:
+            try:
+                await asyncio.wait_for(worker.process.wait(), GRACE)
+            except asyncio.TimeoutError:
+                await worker.kill()
+        self.workers = []
+
+    async def spawn(self):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.abspath(__file__),
+            "--worker",
+            json.dumps(self.options),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        worker = Process(process)
+        try:
+            await worker.receive()
+        except BaseException:
+            await worker.kill()
+            raise
+        self.workers.append(worker)
+        return worker
+
+    async def replace(self, worker):
+        self.workers.remove(worker)
+        await worker.kill()
+        return await self.spawn()
+
+    def register(self, source):
+        """Remember source and return the id jobs can run it by."""
+        pid = program_id(source)
+        self.sources[pid] = source
+        return pid
+
+    async def run(self, source=None, program=None, inputs=None, timeout=None):
+        if source is not None:
+            program = program_id(source)
+        elif program in self.sources:
+            source = self.sources[program]
+        else:
+            raise ValueError(f"Unknown program '{program}'")
+        timeout = self.timeout if timeout is None else timeout
+        job = {"program": program, "inputs": inputs or {}, "timeout": timeout}
+
+        deadline = None if timeout is None else timeout + GRACE
+        worker = await self.acquire()
+        try:
+            response = await asyncio.wait_for(
+                self.send(worker, job, source), deadline
+            )
+        except asyncio.TimeoutError:
+            self.background(self.renew(worker))
+            return self.failure(f"Timed out after {timeout}s")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.background(self.renew(worker))
+            return self.failure("Worker exited")
+        except BaseException:
+            # Cancelled, the worker is released once its result is read
+            self.background(self.drain(worker, deadline))
+            raise
+        self.release(worker)
+        return response
+
+    async def acquire(self):
+        if self.idle and not self.waiting:
+            return self.idle.popleft()
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(future.result())
+            raise
+
+    def release(self, worker):
+        # Unlike asyncio.Queue, a job finishing cannot overtake waiting ones
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_result(worker)
+                return
+        self.idle.append(worker)
+
+    def background(self, coroutine):
+        # Runs even if the job which started it is cancelled
+        task = asyncio.ensure_future(coroutine)
+        self.recovering.add(task)
+        task.add_done_callback(self.recovering.discard)
+
+    async def renew(self, worker):
+        self.release(await self.replace(worker))
+
+    async def drain(self, worker, deadline):
+        """Wait for the result of a cancelled job before worker takes the
+        next one, replacing it if the result does not come."""
+        pending = worker.pending
+        if pending is not None and not pending.done():
+            try:
+                await asyncio.wait_for(pending, deadline)
+            except Exception:
+                await self.renew(worker)
+                return
+        self.release(worker)
+
+    async def send(self, worker, job, source):
+        pid = job["program"]
+        if pid not in worker.known:
+            job["source"] = source
+        response = await worker.request(job)
+        if response.get("missing"):
+            # The worker dropped the program from its cache
+            job["source"] = source
+            response = await worker.request(job)
+        worker.known.add(pid)
+        return response
+
+    @staticmethod
+    def failure(error):
+        return {"stdout": "", "result": None, "error": error}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--worker",
+        metavar="OPTIONS",
+        help="run as a worker process with the given JSON options",
+        required=True,
+    )
+    args = arg_parser.parse_args()
+
+    options = json.loads(args.worker)
+    # Jobs and results use the real stdout, scripts print into a buffer
+    channel = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    Worker(**options).serve(sys.stdin.buffer, channel)
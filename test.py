@@ -1,14 +1,48 @@
 from io import StringIO
+from ast import literal_eval
 import argparse
+import asyncio
+import contextlib
+import json
+import pickle
+import subprocess
 import sys
 import os
-from main import execute
+import tempfile
+from rply import LexingError, ParsingError
+from main import Session, check_source, execute, lexer, parser, run_command
+from lang import ast, dump, serialize, stats
+from lang.limits import Limits, LimitExceeded
+from lang.memo import Memo
+from lang.numeric import Numeric
 from lang.scope import Scope
+from lang.stats import Stats
+from service import Service
 from colorama import Fore, Style, init
 from pathlib import Path
 
 
-def test(path, verbose=False):
+def limit_options(expected):
+    """Split the `LIMITS max_steps=1000 ...` header off expected and return
+    the keyword arguments of Limits it gives, or None without a header."""
+    if not expected.startswith("LIMITS"):
+        return None, expected
+    header, _, expected = expected.partition("\n")
+    return keywords(header.split()[1:]), expected.strip()
+
+
+def keywords(options):
+    """Turn name=value options of a header into keyword arguments."""
+    options = dict(option.split("=") for option in options)
+    return {k: literal_eval(v) for k, v in options.items()}
+
+
+def print_exceeded(err):
+    # The usage values vary between runs, only their names are compared
+    print(f"{err.args[0]} ({', '.join(err.stats)})")
+
+
+def test(path, verbose=False, lazy=False, numeric=False):
     with open(path, "r") as f:
         _, source, expected = f.read().split("###", 2)
         expected = expected.strip()
@@ -21,8 +55,64 @@ def test(path, verbose=False):
             opt = True
             expected = expected[8:].strip()
 
+        # MEMO [SIZE] caches pure functions and prints the cache statistics
+        memo = None
+        if expected.startswith("MEMO"):
+            header, _, expected = expected.partition("\n")
+            size = header.split()[1:]
+            memo = Memo(int(size[0]) if size else 128)
+            expected = expected.strip()
+
+        # STATS counts the run and prints every counter except the time
+        counters = None
+        if expected.startswith("STATS"):
+            counters = Stats()
+            expected = expected[5:].strip()
+
+        options, expected = limit_options(expected)
+        limits = Limits(**options) if options is not None else None
+
+        # LAZY runs with lazily parsed function bodies even without --lazy
+        if expected.startswith("LAZY"):
+            lazy = True
+            expected = expected[4:].strip()
+
         lexer_output = expected.startswith("LEXER OUTPUT")
-        execute(Scope(), source, draw=False, lexer_output=lexer_output, opt=opt)
+        if expected.startswith("CHECK"):
+            # CHECK prints the messages of --check instead of running
+            expected = expected[5:].strip()
+            for error in check_source(source):
+                print(error)
+        elif expected.startswith("DUMP"):
+            # DUMP format [max_depth=N ...] dumps the tree instead of running
+            header, _, expected = expected.partition("\n")
+            format, *options = header.split()[1:]
+            expected = expected.strip()
+            program = parser.parse(lexer.lex(source))
+            dump.dump(program, sys.stdout, format, **keywords(options))
+        else:
+            try:
+                execute(
+                    Scope(),
+                    source,
+                    draw=False,
+                    lexer_output=lexer_output,
+                    opt=opt,
+                    limits=limits,
+                    memo=memo,
+                    stats=counters,
+                    lazy=lazy,
+                    numeric=Numeric() if numeric else None,
+                )
+            except LimitExceeded as err:
+                print_exceeded(err)
+        if memo is not None:
+            for name, entry in sorted(memo.stats().items()):
+                print(f"{name}: {entry['hits']} hits, {entry['misses']} misses")
+        if counters is not None:
+            for name, value in counters.to_dict().items():
+                if name != "time":
+                    print(f"{name}: {value}")
 
         sys.stdout = old_stdout
         actual = actual.getvalue().strip()
@@ -41,6 +131,277 @@ def test(path, verbose=False):
                 print(Fore.YELLOW + actual + Style.RESET_ALL)
 
 
+def run(program, options=None):
+    old_stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    limits = Limits(**options) if options is not None else None
+    try:
+        result = execute(Scope(), program, limits=limits)
+    except LimitExceeded as err:
+        print_exceeded(err)
+        result = None
+    sys.stdout = old_stdout
+    return output.getvalue(), result
+
+
+def test_roundtrip(path):
+    with open(path, "r") as f:
+        source = f.read()
+        options = None
+        if "###" in source:
+            _, source, expected = source.split("###", 2)
+            options, _ = limit_options(expected.strip())
+
+    path = str(path)
+    print(path + Fore.BLUE + "." * (40 - len(path)), end="")
+
+    try:
+        program = parser.parse(lexer.lex(source))
+    except (LexingError, ParsingError):
+        print(Fore.YELLOW + "SKIP" + Style.RESET_ALL)
+        return
+
+    data = serialize.dumps(program)
+    with tempfile.TemporaryDirectory() as tmp:
+        serialized = os.path.join(tmp, "ast.kutc")
+        serialize.dump(program, serialized)
+        loaded = serialize.load(serialized)
+
+    same = run(program, options) == run(loaded, options)
+    if serialize.dumps(loaded) == data and same:
+        print(Fore.GREEN + "PASS" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "FAIL" + Style.RESET_ALL)
+
+
+SLOW = """
+println("slow")
+i := 0
+while i < 300000 {
+    i = i + 1
+}
+i
+"""
+
+
+async def cancelled_job(service):
+    """A cancelled job's result must not be taken for the next job's."""
+    slow = asyncio.ensure_future(service.run(source=SLOW))
+    await asyncio.sleep(0.2)
+    slow.cancel()
+    result = await service.run(source='println("fast")\n2')
+    return result["stdout"] == "fast\n" and result["result"] == 2
+
+
+async def timed_out_job(service):
+    result = await service.run(source=SLOW, timeout=0.1)
+    after = await service.run(source="3")
+    error = result["error"] or ""
+    return error.startswith("Time limit") and after["result"] == 3
+
+
+async def sources(service):
+    """Only registered programs are kept by the service."""
+    program = service.register("4")
+    await service.run(source="5")
+    result = await service.run(program=program)
+    return list(service.sources) == [program] and result["result"] == 4
+
+
+def report(name, passed):
+    print(name + Fore.BLUE + "." * (40 - len(name)), end="")
+    if passed:
+        print(Fore.GREEN + "PASS" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "FAIL" + Style.RESET_ALL)
+
+
+async def test_service():
+    async with Service(workers=1, timeout=5.0) as service:
+        for check in (cancelled_job, timed_out_job, sources):
+            report(f"service {check.__name__}", await check(service))
+
+
+COUNTED = """
+fn kwadrat(x: int) {
+    x * x
+}
+i := 0
+while i < 2 {
+    println(kwadrat(i))
+    i = i + 1
+}
+brak
+"""
+
+COUNTERS = {
+    "nodes": 46,
+    "calls": 2,
+    "scope_pushes": 3,
+    "scope_pops": 3,
+    "lookups": 14,
+    "average_lookup_depth": 1.0,
+    "loop_iterations": 2,
+    "bytes_printed": 4,
+    "errors": 1,
+}
+
+
+def counted(to_dict):
+    return {k: v for k, v in to_dict.items() if k != "time"}
+
+
+def hooks(tmp):
+    events = []
+    counter = Stats()
+    counter.on("call_enter", lambda name: events.append(("enter", name)))
+    counter.on("call_exit", lambda name, value: events.append(("exit", value)))
+    counter.on("loop_iteration", lambda loop: events.append(type(loop).__name__))
+    counter.on("error", lambda err: events.append(str(err)))
+    with contextlib.redirect_stdout(StringIO()):
+        execute(Scope(), COUNTED, stats=counter)
+    return events == [
+        "While",
+        ("enter", "kwadrat"),
+        ("exit", 0),
+        "While",
+        ("enter", "kwadrat"),
+        ("exit", 1),
+        "Undefined identifier 'brak'",
+    ]
+
+
+def json_output(tmp):
+    script = os.path.join(tmp, "counted.kut")
+    output = os.path.join(tmp, "stats.json")
+    with open(script, "w") as f:
+        f.write(COUNTED)
+    run = [sys.executable, "main.py", script, "--stats", output]
+    subprocess.run(run, capture_output=True, check=True)
+    with open(output) as f:
+        written = json.load(f)
+    return "time" in written and counted(written) == COUNTERS
+
+
+def patchable():
+    """The methods a Stats object replaces while it is active."""
+    methods = {
+        cls: vars(cls).get("eval")
+        for cls in vars(ast).values()
+        if isinstance(cls, type) and issubclass(cls, ast.Node)
+    }
+    methods.update({name: getattr(Scope, name) for name in Scope.__dict__})
+    methods["print"] = vars(ast).get("print")
+    return methods
+
+
+def sequential(tmp):
+    """A finished Stats object leaves nothing patched for the next one."""
+    methods = patchable()
+    runs = []
+    for _ in range(2):
+        counter = Stats()
+        with contextlib.redirect_stdout(StringIO()):
+            execute(Scope(), COUNTED, stats=counter)
+        runs.append(counted(counter.to_dict()))
+        if patchable() != methods or stats.active is not None:
+            return False
+    return runs == [COUNTERS, COUNTERS]
+
+
+def test_stats():
+    for check in (hooks, json_output, sequential):
+        with tempfile.TemporaryDirectory() as tmp:
+            report(f"stats {check.__name__}", check(tmp))
+
+
+def command(session, line):
+    """Run a REPL command and return what it printed."""
+    with contextlib.redirect_stdout(StringIO()) as output:
+        run_command(session, line)
+    return output.getvalue()
+
+
+def session_with_definitions():
+    session = Session()
+    session.run("x := 2")
+    session.run("fn triple(n: int) { n * 3 }")
+    return session
+
+
+def session_run(tmp):
+    session = session_with_definitions()
+    with contextlib.redirect_stdout(StringIO()) as output:
+        session.run("missing + 1")
+    error = output.getvalue() == "Undefined identifier 'missing'\n"
+    return error and session.run("triple(x)") == 6
+
+
+def save_load(tmp):
+    path = os.path.join(tmp, "session")
+    saved = command(session_with_definitions(), f":save {path}")
+    session = Session()
+    loaded = command(session, f":load {path}")
+    return saved == loaded == "" and session.run("triple(x)") == 6
+
+
+def save_error(tmp):
+    session = session_with_definitions()
+    output = command(session, f":save {os.path.join(tmp, 'missing', 'session')}")
+    return output.startswith("Cannot save session") and session.run("x") == 2
+
+
+def load_errors(tmp):
+    """Bad snapshots are reported and leave the session as it was."""
+    with open(os.path.join(tmp, "good"), "wb") as f:
+        pickle.dump(session_with_definitions().scope.symbols_stack[-1], f)
+    with open(os.path.join(tmp, "good"), "rb") as f:
+        data = f.read()
+    files = {
+        "empty": b"",
+        "truncated": data[: len(data) // 2],
+        "text": b"not a snapshot\n",
+        "other": pickle.dumps([1, 2]),
+    }
+    for name, content in files.items():
+        with open(os.path.join(tmp, name), "wb") as f:
+            f.write(content)
+
+    session = session_with_definitions()
+    session.run("x = 5")
+    for name in list(files) + ["absent"]:
+        output = command(session, f":load {os.path.join(tmp, name)}")
+        if not output.startswith("Cannot load session"):
+            return False
+    return session.run("triple(x)") == 15
+
+
+def redefinition(tmp):
+    """Calls inside a function follow its callee when an input rebinds it."""
+    session = Session()
+    session.run("fn f(x: int) { x + 1 }")
+    session.run("fn g(x: int) { x * 10 }")
+    session.run("fn use(x: int) { f(x) }")
+    results = [session.run("use(1)")]
+    session.run("f = g")
+    results.append(session.run("use(1)"))
+    path = os.path.join(tmp, "session")
+    command(session, f":save {path}")
+    session.run("fn h(x: int) { x - 1 }")
+    session.run("f = h")
+    results.append(session.run("use(1)"))
+    command(session, f":load {path}")
+    results.append(session.run("use(1)"))
+    return results == [2, 10, 0, 10]
+
+
+def test_repl():
+    checks = (session_run, save_load, save_error, load_errors, redefinition)
+    for check in checks:
+        with tempfile.TemporaryDirectory() as tmp:
+            report(f"repl {check.__name__}", check(tmp))
+
+
 if __name__ == "__main__":
     init()
     arg_parser = argparse.ArgumentParser()
@@ -50,9 +411,59 @@ if __name__ == "__main__":
         help="show actual and expected output in case of an error",
         action="store_true",
     )
+    arg_parser.add_argument(
+        "-r",
+        "--roundtrip",
+        help="check that tests and examples survive AST serialization",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-l",
+        "--lazy",
+        help="parse function bodies when they are first called",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-n",
+        "--numeric",
+        help="run int and float only code on typed storage",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "-s",
+        "--service",
+        help="check the execution service",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--repl",
+        help="check REPL sessions and their snapshots",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--stats",
+        help="check execution statistics and their hooks",
+        action="store_true",
+    )
     args = arg_parser.parse_args()
 
-    tests_dir = Path("tests")
-    (_, _, tests) = next(os.walk(tests_dir))
-    for t in tests:
-        test(tests_dir / t, verbose=args.verbose)
+    if args.service:
+        asyncio.run(test_service())
+    elif args.repl:
+        test_repl()
+    elif args.stats:
+        test_stats()
+    elif args.roundtrip:
+        for directory in (Path("tests"), Path("examples")):
+            for t in sorted(directory.glob("*.kut")):
+                test_roundtrip(t)
+    else:
+        tests_dir = Path("tests")
+        (_, _, tests) = next(os.walk(tests_dir))
+        for t in tests:
+            test(
+                tests_dir / t,
+                verbose=args.verbose,
+                lazy=args.lazy,
+                numeric=args.numeric,
+            )